@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import fakeapi
+import httpclient
+import internet_roadtrip_panos
+import irtpanos
+import panocache
+import panoindex
+import ratelimit
+
+# Prediction benchmark over recorded stops. Each implementation runs against
+# a local fakeapi stand-in (so numbers are comparable between changes and cost
+# no quota), with its own scratch cache, for one or more passes over the stops.
+# The first pass is cold; later passes show how much the cache saves.
+# Requests are not rate limited unless --rate-limit is given, so the numbers
+# measure the code rather than the pacing meant for the real API.
+BATCH_SIZE = 100
+
+
+def load_stops(path):
+    """Reads recorded stops from a JSON list (like failed.json) or JSON lines."""
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def run_predict_options(stops):
+    predictions, latencies = [], []
+    for item in stops:
+        start = time.perf_counter()
+        options = internet_roadtrip_panos.predict_options(item['pano'], float(item['heading']))
+        latencies.append(time.perf_counter() - start)
+        predictions.append(set(option['pano'] for option in options))
+    return predictions, latencies
+
+
+def run_predict_options_many(stops):
+    # Every stop in a batch is charged an equal share of the batch's time.
+    predictions, latencies = [], []
+    for start_index in range(0, len(stops), BATCH_SIZE):
+        batch = stops[start_index:start_index + BATCH_SIZE]
+        start = time.perf_counter()
+        results = internet_roadtrip_panos.predict_options_many(
+            [(item['pano'], float(item['heading'])) for item in batch])
+        elapsed = time.perf_counter() - start
+        latencies.extend([elapsed / len(batch)] * len(batch))
+        predictions.extend(set(option['pano'] for option in options) for options in results)
+    return predictions, latencies
+
+
+def run_repro_irt(stops):
+    predictions, latencies = [], []
+    for item in stops:
+        start = time.perf_counter()
+        try:
+            # repro_irt reports as it goes; keep that out of the results.
+            with contextlib.redirect_stdout(io.StringIO()):
+                options = irtpanos.repro_irt(item['pano'], float(item['heading'])) or []
+        except SystemExit:
+            options = []
+        latencies.append(time.perf_counter() - start)
+        predictions.append(set(pano for pano, _ in options))
+    return predictions, latencies
+
+
+IMPLEMENTATIONS = {
+    "predict_options": run_predict_options,
+    "predict_options_many": run_predict_options_many,
+    "repro_irt": run_repro_irt,
+}
+
+
+def summarize(name, pass_number, stops, predictions, latencies, api_calls, cache):
+    actual = [set(option['pano'] for option in item['options']) for item in stops]
+    exact = sum(1 for predicted, expected in zip(predictions, actual) if predicted == expected)
+    lookups = cache.hits + cache.misses
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "implementation": name,
+        "pass": pass_number,
+        "stops": len(stops),
+        "api_calls_per_stop": sum(api_calls.values()) / len(stops),
+        "metadata_calls": api_calls["GET"],
+        "pano_ids_calls": api_calls["POST"],
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "cache_hit_ratio": cache.hits / lookups if lookups else 0.0,
+        "accuracy": exact / len(stops),
+        "missing_options": sum(len(expected - predicted) for predicted, expected in zip(predictions, actual)),
+        "extra_options": sum(len(predicted - expected) for predicted, expected in zip(predictions, actual)),
+    }
+
+
+def run(stops, server, implementations, passes=2, index=None):
+    """Benchmarks each implementation over stops against a running fakeapi server.
+
+    Tile API calls go to the server for the duration of the run. Each
+    implementation gets a scratch cache, and a scratch pano index unless an
+    existing PanoIndex is given to measure offline panoIds answers.
+
+    Returns:
+        A list of summary dicts, one per implementation and pass.
+    """
+    report = []
+    httpclient.configure(base_url=server.url)
+    try:
+        for name in implementations:
+            with tempfile.TemporaryDirectory() as scratch:
+                cache = panocache.PanoCache(os.path.join(scratch, "bench.sqlite"))
+                panocache.use_cache(cache)
+                panoindex.use_index(index or panoindex.PanoIndex(os.path.join(scratch, "index.sqlite")))
+                for pass_number in range(1, passes + 1):
+                    cache.hits = cache.misses = 0
+                    server.stats.clear()
+                    predictions, latencies = IMPLEMENTATIONS[name](stops)
+                    report.append(summarize(name, pass_number, stops, predictions, latencies,
+                                            server.stats.copy(), cache))
+                panocache.use_cache(None)
+                panoindex.use_index(None)
+    finally:
+        httpclient.configure()
+    return report
+
+
+def print_report(report):
+    columns = ["implementation", "pass", "api_calls_per_stop", "p50_ms", "p95_ms", "p99_ms",
+               "cache_hit_ratio", "accuracy"]
+    print("  ".join(f"{column:>20}" for column in columns))
+    for row in report:
+        print("  ".join(f"{row[column]:>20.3f}" if isinstance(row[column], float) else f"{row[column]:>20}"
+                        for column in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the prediction path over recorded stops.")
+    parser.add_argument("stops", help="Recorded stops, e.g. failed.json or a .jsonl file.")
+    parser.add_argument("fixtures", help="Fixture .jsonl file or panocache .sqlite database for fakeapi.")
+    parser.add_argument("--implementations", default=",".join(IMPLEMENTATIONS),
+                        help="Comma-separated list from: " + ", ".join(IMPLEMENTATIONS))
+    parser.add_argument("--passes", type=int, default=2, help="Passes over the stops per implementation.")
+    parser.add_argument("--limit", type=int, help="Only use the first N stops.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Injected API latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.005, help="Injected latency standard deviation.")
+    parser.add_argument("--index", help="Existing panoindex database to answer panoIds from.")
+    parser.add_argument("--json", help="Also write the report to this file.")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="Pace requests to the fake API as if it were the real one.")
+    args = parser.parse_args()
+
+    stops = load_stops(args.stops)[:args.limit]
+    if args.fixtures.endswith(".jsonl"):
+        fixtures = fakeapi.Fixtures().load(args.fixtures)
+    else:
+        fixtures = fakeapi.Fixtures().load_cache(args.fixtures)
+    server = fakeapi.serve(fixtures, port=0, latency=args.latency, jitter=args.jitter)
+    if not args.rate_limit:
+        ratelimit.disable()
+
+    index = panoindex.PanoIndex(args.index) if args.index else None
+    report = run(stops, server, args.implementations.split(","), args.passes, index)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    server.shutdown()
@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import threading
+import time
+import metrics
+
+# Buffered BigQuery writer for the stop stream. Rows are appended to a local
+# spool file as they arrive, so they survive BigQuery outages and restarts,
+# and a background thread inserts them in batches once enough have built up
+# or the oldest has waited long enough. Every row carries a deterministic
+# insert ID, so a batch retried after a timeout or replayed from the spool
+# after a restart is deduplicated by BigQuery instead of stored twice.
+#
+# The spool is append-only. Delivered rows are acknowledged by writing the
+# spool offset before which everything has been delivered to a small .ack
+# file next to it; a restart replays from there. Once COMPACT_BYTES have been
+# acknowledged the spool is rewritten without them, mostly outside the lock
+# add() needs. Offsets are logical (bytes of rows ever spooled), and the
+# spool's first line records the offset it starts at, so the .ack file stays
+# valid across compactions.
+SPOOL_FILE = os.environ.get("STOP_SPOOL_FILE", "stops.spool.jsonl")
+MAX_ROWS = 500  # Rows per insert call
+MAX_AGE = 30.0  # Seconds a row may wait before its batch is flushed
+RETRY_DELAY = 5.0  # Seconds before retrying a failed insert, doubled on each failure
+MAX_RETRY_DELAY = 300.0
+COMPACT_BYTES = 16 * 1024 * 1024  # Acknowledged spool bytes that trigger a compaction
+COPY_SIZE = 1024 * 1024
+RETRYABLE_REASONS = ("stopped", "timeout", "backendError", "internalError")  # Row errors worth retrying
+
+
+def insert_id(row):
+    """Returns the insert ID for a stop row; the same stop always gets the same ID."""
+    return "%s:%s:%s" % (row.get("stop"), row.get("pano"), row.get("endTime"))
+
+
+def spool_header(base):
+    return (json.dumps({"base": base}) + "\n").encode()
+
+
+class SpoolWriter:
+    """Spools rows to disk and delivers them in batches from a background thread.
+
+    add() only appends to the spool, so it never waits on delivery. Rows not
+    yet acknowledged when the process starts are queued again. Subclasses
+    implement deliver().
+    """
+
+    sink = "spool"  # Label for the pending rows gauge
+
+    def __init__(self, spool_path=SPOOL_FILE, max_rows=MAX_ROWS, max_age=MAX_AGE):
+        self.spool_path = spool_path
+        self.ack_path = spool_path + ".ack"
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self._pending = []  # (insert_id, row, added_at, offset)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._retry_delay = RETRY_DELAY
+        self._recover()
+        self._spool = open(spool_path, "ab")
+        metrics.spool_pending_rows.set(len(self._pending), sink=self.sink)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _recover(self):
+        """Queues the rows spooled after the acknowledged offset."""
+        acked = 0
+        if os.path.exists(self.ack_path):
+            with open(self.ack_path) as f:
+                acked = int(f.read().strip() or 0)
+        self._base, self._header_size = 0, 0
+        if not os.path.exists(self.spool_path):
+            with open(self.spool_path, "wb") as f:
+                f.write(spool_header(0))
+            self._header_size = len(spool_header(0))
+            self._offset = 0
+            return
+        with open(self.spool_path, "r+b") as f:
+            first = f.readline()
+            try:
+                self._base = json.loads(first)["base"]
+                self._header_size = len(first)
+            except (ValueError, KeyError, TypeError):
+                pass  # A spool without a header starts at offset 0
+            position = self._header_size + max(acked - self._base, 0)
+            f.seek(position)
+            now = time.monotonic()
+            for line in f:
+                if not line.endswith(b"\n"):
+                    logging.warning(f"Dropping a partly written row at the end of {self.spool_path}")
+                    f.truncate(position)
+                    break
+                if line.strip():
+                    entry = json.loads(line)
+                    self._pending.append((entry["insert_id"], entry["row"], now,
+                                          self._base + position - self._header_size))
+                position += len(line)
+            self._offset = self._base + position - self._header_size
+        if self._pending:
+            logging.info(f"Recovered {len(self._pending)} spooled rows from {self.spool_path}")
+
+    def add(self, row):
+        row_id = insert_id(row)
+        data = (json.dumps({"insert_id": row_id, "row": row}) + "\n").encode()
+        with self._cond:
+            self._spool.write(data)
+            self._spool.flush()
+            os.fsync(self._spool.fileno())
+            self._pending.append((row_id, row, time.monotonic(), self._offset))
+            self._offset += len(data)
+            metrics.spool_pending_rows.set(len(self._pending), sink=self.sink)
+            if len(self._pending) >= self.max_rows:
+                self._cond.notify()
+
+    def deliver(self, batch):
+        """Delivers a batch of (insert_id, row, added_at, offset) entries.
+
+        Returns:
+            The entries to retry later; raising retries the whole batch.
+        """
+        raise NotImplementedError
+
+    def _due(self):
+        if not self._pending:
+            return False
+        return (self._closed or len(self._pending) >= self.max_rows
+                or time.monotonic() - self._pending[0][2] >= self.max_age)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._closed:
+                        return
+                    timeout = self.max_age - (time.monotonic() - self._pending[0][2]) if self._pending else None
+                    self._cond.wait(timeout)
+                batch = self._pending[:self.max_rows]
+            try:
+                retry = self.deliver(batch) or []
+            except Exception as e:
+                logging.error(f"Failed to deliver {len(batch)} rows, will retry: {e}")
+                retry = batch
+            if len(retry) < len(batch):
+                self._acknowledge(batch, retry)
+            if not retry:
+                self._retry_delay = RETRY_DELAY
+            else:
+                with self._cond:
+                    if self._closed:
+                        return
+                    self._cond.wait(self._retry_delay)
+                self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_DELAY)
+
+    def _acknowledge(self, batch, retry):
+        """Drops a delivered batch, keeping the entries to retry, and records the new offset."""
+        with self._cond:
+            del self._pending[:len(batch)]
+            self._pending[:0] = retry
+            acked = self._pending[0][3] if self._pending else self._offset
+            metrics.spool_pending_rows.set(len(self._pending), sink=self.sink)
+        tmp_path = self.ack_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(acked))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.ack_path)
+        if acked - self._base >= COMPACT_BYTES:
+            self._compact(acked)
+
+    def _compact(self, acked):
+        """Rewrites the spool without the bytes before acked.
+
+        The bulk of the copy runs without the lock; only rows added while it
+        ran are copied with the lock held, before the new spool replaces the
+        old one.
+        """
+        header = spool_header(acked)
+        tmp_path = self.spool_path + ".tmp"
+        with self._cond:
+            end = self._offset
+        with open(self.spool_path, "rb") as source, open(tmp_path, "wb") as target:
+            target.write(header)
+            source.seek(self._header_size + acked - self._base)
+            remaining = end - acked
+            while remaining > 0:
+                chunk = source.read(min(COPY_SIZE, remaining))
+                if not chunk:
+                    break
+                target.write(chunk)
+                remaining -= len(chunk)
+            with self._cond:
+                source.seek(self._header_size + end - self._base)
+                target.write(source.read())
+                target.flush()
+                os.fsync(target.fileno())
+                os.replace(tmp_path, self.spool_path)
+                self._spool.close()
+                self._spool = open(self.spool_path, "ab")
+                self._base, self._header_size = acked, len(header)
+        logging.info(f"Compacted {self.spool_path} to start at offset {acked}")
+
+    def close(self, timeout=30):
+        """Delivers what is pending (waiting at most timeout seconds) and stops the writer."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        with self._cond:
+            self._spool.close()
+
+
+class BatchWriter(SpoolWriter):
+    """Spools rows to disk and inserts them into a BigQuery table in batches."""
+
+    sink = "bigquery"
+
+    def __init__(self, client, table, spool_path=SPOOL_FILE, max_rows=MAX_ROWS, max_age=MAX_AGE):
+        self.client = client
+        self.table = table
+        super().__init__(spool_path, max_rows, max_age)
+
+    def deliver(self, batch):
+        try:
+            with metrics.function_seconds.time(function="insert_rows_json"):
+                errors = self.client.insert_rows_json(
+                    self.table, [entry[1] for entry in batch], row_ids=[entry[0] for entry in batch])
+        except Exception:
+            metrics.ws_errors.inc(kind="insert")
+            raise
+        retry, dropped = [], 0
+        for error in errors or []:
+            reasons = [detail.get("reason") for detail in error.get("errors", [])]
+            if reasons and all(reason in RETRYABLE_REASONS for reason in reasons):
+                retry.append(batch[error["index"]])
+            else:
+                # Invalid rows, and errors we can't classify, would fail the same way forever.
+                dropped += 1
+                metrics.ws_errors.inc(kind="insert")
+                logging.error(f"Dropping row {batch[error['index']][0]}: {error}")
+        logging.info(f"Inserted {len(batch) - len(retry) - dropped} rows"
+                     + (f", {len(retry)} to retry" if retry else ""))
+        return retry
@@ -0,0 +1,335 @@
+import argparse
+import concurrent.futures
+import geodesy
+import json
+import math
+import os
+import sqlite3
+import threading
+import geojsonstream
+import internet_roadtrip_panos
+import panograph
+import ratelimit
+import sv
+
+# Multi-process crawl coordinator. The area to map is cut into square tiles
+# and each tile is crawled by sv.crawl in a worker process, which only
+# follows links into its own tile. Where a link leads is estimated without
+# fetching it, LINK_STEP meters from the linking pano along the link's
+# heading; links estimated to lead into other tiles are handed to those
+# tiles, with the linking pano so their lines join up, through a shared
+# SQLite store. The store also records every pano claimed so far, including
+# panos claimed to be prefetched, so no pano is fetched or processed twice
+# however the crawls meet. Each tile writes its own newline-delimited
+# GeoJSON part and adjacency, merged into one output and one panograph store
+# when every tile is done.
+STORE_FILE = "crawl.sqlite"
+PARTS_DIR = "crawl_parts"
+TILE_SIZE = 0.05  # Degrees per tile side, roughly 5 km
+SEED_GRID = 4  # Sample points per tile side when seeding from a bounding box
+SEED_RADIUS = 500  # Meters searched around each sample point for a seed pano
+MAX_TILES = 100  # Tiles crawled at most when no bounding box limits the crawl
+LINK_STEP = 10  # Meters from a pano to the panos it links to, for guessing their tile
+POLL_INTERVAL = 1.0  # Seconds between checks for newly queued tiles while crawls run
+
+
+def tile_for(lat, lng, tile_size=TILE_SIZE):
+    return (math.floor(lat / tile_size), math.floor(lng / tile_size))
+
+
+class CrawlStore:
+    """Visited set and per-tile frontier shared by every crawl process."""
+
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS visited (pano_id TEXT PRIMARY KEY, owner TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS frontier ("
+                " pano_id TEXT PRIMARY KEY,"
+                " tile_row INTEGER NOT NULL,"
+                " tile_col INTEGER NOT NULL,"
+                " parent_id TEXT,"
+                " parent_lat REAL,"
+                " parent_lng REAL)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def clear(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM visited")
+            conn.execute("DELETE FROM frontier")
+            conn.commit()
+
+    def claim(self, pano_id, owner):
+        """Marks pano_id visited by owner. Returns False if another owner already had it."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("INSERT OR IGNORE INTO visited (pano_id, owner) VALUES (?, ?)", (pano_id, owner))
+            conn.commit()
+            row = conn.execute("SELECT owner FROM visited WHERE pano_id = ?", (pano_id,)).fetchone()
+        return row[0] == owner
+
+    def release(self, pano_ids, owner):
+        """Gives up owner's claims on pano_ids, e.g. panos prefetched but never processed."""
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("DELETE FROM visited WHERE pano_id = ? AND owner = ?",
+                             [(pano_id, owner) for pano_id in pano_ids])
+            conn.commit()
+
+    def add_frontier(self, tile, pano_ids, parent=None):
+        """Queues panos to be crawled by the process that takes tile.
+
+        Args:
+            tile: The tile to crawl them.
+            pano_ids: The panos.
+            parent: Optional (pano_id, lat, lng) of the pano linking to them,
+                where their lines start.
+        """
+        parent = tuple(parent) if parent else (None, None, None)
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR IGNORE INTO frontier (pano_id, tile_row, tile_col, parent_id, parent_lat, parent_lng)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(pano_id,) + tuple(tile) + parent for pano_id in pano_ids],
+            )
+            conn.commit()
+
+    def take_frontier(self, exclude_tiles=()):
+        """Removes and returns the queued panos not yet visited.
+
+        Panos queued for any tile in exclude_tiles are left in the queue.
+
+        Returns:
+            {tile: [(pano_id, parent or None), ...]}, parent as in add_frontier.
+        """
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute(
+                "SELECT pano_id, tile_row, tile_col, parent_id, parent_lat, parent_lng FROM frontier"
+                " WHERE pano_id NOT IN (SELECT pano_id FROM visited)"
+                " ORDER BY rowid"
+            ).fetchall()
+            rows = [row for row in rows if (row[1], row[2]) not in exclude_tiles]
+            conn.executemany("DELETE FROM frontier WHERE pano_id = ?", [(row[0],) for row in rows])
+            conn.execute("DELETE FROM frontier WHERE pano_id IN (SELECT pano_id FROM visited)")
+            conn.commit()
+        tiles = {}
+        for pano_id, row, col, parent_id, parent_lat, parent_lng in rows:
+            parent = (parent_id, parent_lat, parent_lng) if parent_id else None
+            tiles.setdefault((row, col), []).append((pano_id, parent))
+        return tiles
+
+
+def in_bbox(lat, lng, bbox):
+    min_lat, min_lng, max_lat, max_lng = bbox
+    return min_lat <= lat <= max_lat and min_lng <= lng <= max_lng
+
+
+def link_tile(data, link, tile_size=TILE_SIZE):
+    """Guesses the tile a linked pano is in from the linking pano's position and the link heading."""
+    lat, lng = geodesy.destination(data["lat"], data["lng"], link.get("heading", 0.0), LINK_STEP)
+    return tile_for(float(lat), float(lng), tile_size)
+
+
+def crawl_partition(store_path, tile, seeds, part, tile_size, bbox, max_depth, fetch_workers):
+    """Crawls one tile from its seeds. Runs in a worker process.
+
+    Writes the tile's features to part + ".ndjson" and the adjacency of the
+    panos it processed to part + ".nodes.json".
+
+    Args:
+        seeds: (pano_id, parent) pairs from CrawlStore.take_frontier.
+
+    Returns:
+        The number of panos processed.
+    """
+    store = CrawlStore(store_path)
+    tile = tuple(tile)
+    claimed = set()
+
+    def claim(pano_id):
+        if store.claim(pano_id, part):
+            claimed.add(pano_id)
+            return True
+        return False
+
+    def accept(pano_id, data):
+        return bbox is None or in_bbox(data["lat"], data["lng"], bbox)
+
+    def follow(data, link):
+        return link_tile(data, link, tile_size) == tile
+
+    def hand_off(pano_id, data, link):
+        other = link_tile(data, link, tile_size)
+        lat, lng = geodesy.destination(data["lat"], data["lng"], link.get("heading", 0.0), LINK_STEP)
+        if bbox is None or in_bbox(float(lat), float(lng), bbox):
+            store.add_frontier(other, [link["panoId"]], (pano_id, data["lat"], data["lng"]))
+
+    with geojsonstream.FeatureWriter(part + ".ndjson") as writer:
+        sv.reset(writer)
+        for seed, parent in seeds:
+            # A handed-off pano's line starts at the pano that linked to it.
+            path = ([parent[2], parent[1]], parent[0], None) if parent else None
+            sv.crawl(seed, max_depth, workers=fetch_workers, stack=[(seed, 0, path)],
+                     accept=accept, claim=claim, follow=follow, hand_off=hand_off)
+    # Let other crawls have the panos prefetched here but never reached.
+    store.release(claimed - sv.processed_pano_ids, part)
+    with open(part + ".nodes.json", "w") as f:
+        json.dump(sv.graph_nodes, f, separators=(",", ":"))
+    return len(sv.graph_nodes)
+
+
+def bbox_seeds(bbox, tile_size=TILE_SIZE):
+    """Finds seed panos for every tile in a bounding box.
+
+    Returns:
+        {tile: [pano_id, ...]} from a SEED_GRID x SEED_GRID panoIds sample of
+        each tile, clipped to the box.
+    """
+    min_lat, min_lng, max_lat, max_lng = bbox
+    first_row, first_col = tile_for(min_lat, min_lng, tile_size)
+    last_row, last_col = tile_for(max_lat, max_lng, tile_size)
+    tiles, groups = [], []
+    for row in range(first_row, last_row + 1):
+        for col in range(first_col, last_col + 1):
+            step = tile_size / SEED_GRID
+            points = [(row * tile_size + (i + 0.5) * step, col * tile_size + (j + 0.5) * step)
+                      for i in range(SEED_GRID) for j in range(SEED_GRID)]
+            points = [point for point in points if in_bbox(point[0], point[1], bbox)]
+            if points:
+                tiles.append((row, col))
+                groups.append(points)
+    results = internet_roadtrip_panos.get_pano_ids_many(groups, SEED_RADIUS)
+    seeds = {}
+    for tile, pano_ids in zip(tiles, results):
+        pano_ids = list(dict.fromkeys(pano_id for pano_id in pano_ids if pano_id))
+        if pano_ids:
+            seeds[tile] = pano_ids
+    return seeds
+
+
+def merge(parts, output, graph_dir):
+    """Merges the per-tile parts into one GeoJSON output and one panograph store."""
+    nodes = {}
+    with geojsonstream.FeatureWriter(output) as writer:
+        for part in parts:
+            with open(part + ".ndjson") as f:
+                for line in f:
+                    if line.strip():
+                        writer.write(json.loads(line))
+            with open(part + ".nodes.json") as f:
+                for pano_id, (lat, lng, original_lat, original_lng, links) in json.load(f).items():
+                    nodes[pano_id] = (lat, lng, original_lat, original_lng, [tuple(link) for link in links])
+    graph = panograph.from_nodes(nodes)
+    graph.save(graph_dir)
+    return writer.count, graph
+
+
+def coordinate(seeds=(), bbox=None, output="output.geojson", graph_dir="output.graph", workers=4,
+               store_path=STORE_FILE, parts_dir=PARTS_DIR, tile_size=TILE_SIZE, max_depth=sv.MAX_DEPTH,
+               max_tiles=MAX_TILES, fetch_workers=sv.FETCH_WORKERS):
+    """Crawls from seed panos and/or every tile of a bounding box across worker processes.
+
+    Tiles are handed to the pool as panos are queued for them; a tile can be
+    crawled again later if more panos are handed to it after its first run.
+    Without a bounding box the crawl spreads to at most max_tiles tiles.
+
+    Args:
+        seeds: Pano IDs to start from.
+        bbox: (min_lat, min_lng, max_lat, max_lng) to crawl, or None.
+        output: The merged GeoJSON file.
+        graph_dir: Where the merged panograph store is saved.
+        workers: Crawl processes; they split the API rate limits between them.
+        store_path: The shared visited set and frontier, cleared at the start.
+        parts_dir: Where the per-tile outputs are written.
+        tile_size: Degrees per tile side.
+        max_depth: Passed to sv.crawl for each seed.
+        max_tiles: Tile budget when there is no bounding box.
+        fetch_workers: Metadata requests in flight per crawl process.
+
+    Returns:
+        The number of panos crawled.
+    """
+    os.makedirs(parts_dir, exist_ok=True)
+    store = CrawlStore(store_path)
+    store.clear()
+    for seed in seeds:
+        data = sv.fetch_metadata(seed)
+        if not data or "lat" not in data:
+            print(f"Skipping seed {seed}: no metadata")
+            continue
+        store.add_frontier(tile_for(data["lat"], data["lng"], tile_size), [seed])  # Cached for the crawl
+    if bbox is not None:
+        for tile, pano_ids in bbox_seeds(bbox, tile_size).items():
+            store.add_frontier(tile, pano_ids)
+
+    started = set()
+    running = {}
+    parts = []
+    crawled = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=ratelimit.share,
+                                                initargs=(workers,)) as pool:
+        while True:
+            for tile, pano_ids in store.take_frontier(set(running.values())).items():
+                if bbox is None and tile not in started and len(started) >= max_tiles:
+                    print(f"Tile budget reached, not crawling tile {tile}")
+                    continue
+                started.add(tile)
+                part = os.path.join(parts_dir, "%d_%d.%d" % (tile[0], tile[1], len(parts)))
+                parts.append(part)
+                future = pool.submit(crawl_partition, store_path, tile, pano_ids, part, tile_size,
+                                     bbox, max_depth, fetch_workers)
+                running[future] = tile
+            if not running:
+                break
+            # Wake up now and then to start tiles the running crawls have queued panos for.
+            finished, _ = concurrent.futures.wait(running, timeout=POLL_INTERVAL,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                tile = running.pop(future)
+                count = future.result()
+                crawled += count
+                print(f"Tile {tile} done: {count} panos ({crawled} in total)")
+
+    features, graph = merge(parts, output, graph_dir)
+    print(f"Merged {len(parts)} parts from {len(started)} tiles: {features} features in {output},"
+          f" {len(graph)} panos in {graph_dir}")
+    return crawled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl panos across worker processes, partitioned by tile.")
+    parser.add_argument("seeds", nargs="*", help="PanoIDs to start from.")
+    parser.add_argument("--bbox", help="min_lat,min_lng,max_lat,max_lng to crawl every tile of.")
+    parser.add_argument("--workers", type=int, default=4, help="Crawl processes.")
+    parser.add_argument("--output", default="output.geojson", help="Merged GeoJSON; .ndjson for one feature per line.")
+    parser.add_argument("--graph", default="output.graph", help="Where the merged pano graph is saved.")
+    parser.add_argument("--store", default=STORE_FILE, help="Shared visited set database.")
+    parser.add_argument("--parts", default=PARTS_DIR, help="Directory for per-tile outputs.")
+    parser.add_argument("--tile-size", type=float, default=TILE_SIZE, help="Degrees per tile side.")
+    parser.add_argument("--max-depth", type=int, default=sv.MAX_DEPTH)
+    parser.add_argument("--max-tiles", type=int, default=MAX_TILES, help="Tile budget without --bbox.")
+    parser.add_argument("--fetch-workers", type=int, default=sv.FETCH_WORKERS,
+                        help="Metadata requests in flight per process.")
+    args = parser.parse_args()
+    if not args.seeds and not args.bbox:
+        parser.error("give seed PanoIDs, --bbox, or both")
+    bbox = tuple(float(value) for value in args.bbox.split(",")) if args.bbox else None
+    coordinate(args.seeds, bbox, args.output, args.graph, args.workers, args.store, args.parts,
+               args.tile_size, args.max_depth, args.max_tiles, args.fetch_workers)
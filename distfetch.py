@@ -1,6 +1,6 @@
 import csv
-import time
 import requests
+import httpclient
 
 # Constants
 API_ENDPOINT = "https://roadtrip.pikarocks.dev/query"
@@ -29,7 +29,7 @@ def fetch_data(start_time, offset, limit):
       "endTime": start_time + 44,  # 44 seconds after start time
   }
   try:
-    response = requests.get(API_ENDPOINT, params=params)
+    response = httpclient.get(API_ENDPOINT, params=params)
     response.raise_for_status()  # Raise an exception for bad status codes
     data = response.json()
     if "results" in data and data["results"]:
@@ -82,7 +82,6 @@ if __name__ == "__main__":
       previous_distance = distance
     else:
       print(f"No record found for offset {offset} and start_time {start_time}")
-    time.sleep(0.1)  # Add a small delay to avoid overloading the API
 
   print("\nAll Fetched Results:")
   # Write results to CSV
@@ -0,0 +1,212 @@
+import argparse
+import collections
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+import panocache
+import panoindex
+
+# Local stand-in for the Street View Tile API endpoints used by
+# internet_roadtrip_panos, irtpanos, sv.py and listpanos. Responses come from
+# a recorded fixture corpus, with optional injected latency and errors, so the
+# prediction and crawl paths can be benchmarked offline. Point the clients at
+# it with TILE_API_URL=http://127.0.0.1:8082.
+#
+# Fixtures are JSON lines of {"kind": ..., "key": ..., "data": ...}, the same
+# entries panocache stores; "export" dumps a warm cache into that format.
+PORT = 8082
+
+
+class Fixtures:
+    """Recorded metadata and panoIds responses, with a spatial index of panos."""
+
+    def __init__(self):
+        self.metadata = {}
+        self.recorded_points = {}
+        self.index = panoindex.PanoIndex(":memory:")
+
+    def add(self, kind, key, data):
+        if kind == panocache.METADATA:
+            self.metadata[key] = data
+        elif kind == panocache.PANO_IDS:
+            # Recorded requests may have been batched differently from the
+            # ones we will be asked, so remember the answer for each point.
+            radius, points = key.split("|", 1)
+            for point, pano_id in zip(points.split(","), data):
+                self.recorded_points[(radius, point)] = pano_id
+
+    def load(self, path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.add(entry["kind"], entry["key"], entry["data"])
+        self.build_index()
+        return self
+
+    def load_cache(self, path):
+        cache = panocache.PanoCache(path, ttl=0)
+        for kind in (panocache.METADATA, panocache.PANO_IDS):
+            for key, data in cache.items(kind):
+                self.add(kind, key, data)
+        self.build_index()
+        return self
+
+    def build_index(self):
+        """Indexes the position of every loaded metadata fixture."""
+        self.index.add_panos(
+            (pano_id, data["lat"], data["lng"])
+            for pano_id, data in self.metadata.items()
+            if "lat" in data and "lng" in data
+        )
+
+    def nearest_pano(self, lat, lng, radius):
+        """Returns the recorded pano closest to (lat, lng) within radius meters, or ''."""
+        point = "%.7f:%.7f" % (lat, lng)
+        recorded = self.recorded_points.get((str(radius), point))
+        if recorded is not None:
+            return recorded
+        return self.index.nearest(lat, lng, radius)
+
+
+def error_body(code, status, message):
+    return {"error": {"code": code, "message": message, "status": status}}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        if parsed.path != "/v1/streetview/metadata":
+            return self.reply(404, error_body(404, "NOT_FOUND", "Unknown endpoint."))
+        if self.inject():
+            return
+        pano_id = urllib.parse.parse_qs(parsed.query).get("panoId", [""])[0]
+        data = self.server.fixtures.metadata.get(pano_id)
+        if data is None:
+            return self.reply(404, error_body(404, "NOT_FOUND", f"Pano {pano_id} is not in the fixtures."))
+        self.reply(200, data)
+
+    def do_POST(self):
+        parsed = urllib.parse.urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if parsed.path != "/v1/streetview/panoIds":
+            return self.reply(404, error_body(404, "NOT_FOUND", "Unknown endpoint."))
+        if self.inject():
+            return
+        try:
+            payload = json.loads(body)
+            radius = payload.get("radius", 50)
+            pano_ids = [self.server.fixtures.nearest_pano(loc["lat"], loc["lng"], radius)
+                        for loc in payload["locations"]]
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, error_body(400, "INVALID_ARGUMENT", f"Bad request: {e}"))
+        self.reply(200, {"panoIds": pano_ids})
+
+    def inject(self):
+        """Sleeps for the configured latency and maybe sends an error. Returns True if it did."""
+        server = self.server
+        with server.stats_lock:
+            server.stats[self.command] += 1
+        if server.latency or server.jitter:
+            time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        roll = random.random()
+        if roll < server.throttle_rate:
+            self.reply(429, error_body(429, "RESOURCE_EXHAUSTED", "Injected quota error."))
+            return True
+        if roll < server.throttle_rate + server.error_rate:
+            self.reply(500, error_body(500, "INTERNAL", "Injected server error."))
+            return True
+        return False
+
+    def reply(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(fixtures, port=PORT, latency=0, jitter=0, error_rate=0, throttle_rate=0, verbose=False):
+    """Starts the stand-in on a background thread.
+
+    Args:
+        fixtures: The Fixtures to serve.
+        port: The port to listen on; 0 picks a free one.
+        latency: Mean added latency per request, in seconds.
+        jitter: Standard deviation of the added latency, in seconds.
+        error_rate: Fraction of requests answered with a 500.
+        throttle_rate: Fraction of requests answered with a 429.
+        verbose: Log every request.
+
+    Returns:
+        The running server. Its base URL is server.url, request counts per
+        method are in server.stats, and server.shutdown() stops it.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.fixtures = fixtures
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.throttle_rate = throttle_rate
+    server.verbose = verbose
+    server.stats = collections.Counter()
+    server.stats_lock = threading.Lock()
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def export(cache_path, output_path):
+    """Writes every entry in a panocache database out as a fixture file."""
+    cache = panocache.PanoCache(cache_path, ttl=0)
+    count = 0
+    with open(output_path, "w") as f:
+        for kind in (panocache.METADATA, panocache.PANO_IDS):
+            for key, data in cache.items(kind):
+                f.write(json.dumps({"kind": kind, "key": key, "data": data}) + "\n")
+                count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Street View Tile API stand-in.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Serve recorded fixtures.")
+    serve_parser.add_argument("fixtures", help="Fixture .jsonl file or panocache .sqlite database.")
+    serve_parser.add_argument("--port", type=int, default=PORT)
+    serve_parser.add_argument("--latency", type=float, default=0, help="Mean added latency in seconds.")
+    serve_parser.add_argument("--jitter", type=float, default=0, help="Latency standard deviation in seconds.")
+    serve_parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests failing with 500.")
+    serve_parser.add_argument("--throttle-rate", type=float, default=0, help="Fraction of requests failing with 429.")
+    serve_parser.add_argument("--verbose", action="store_true")
+    export_parser = subparsers.add_parser("export", help="Dump a panocache database as fixtures.")
+    export_parser.add_argument("cache", help="panocache .sqlite database.")
+    export_parser.add_argument("output", help="Fixture .jsonl file to write.")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        print(f"Wrote {export(args.cache, args.output)} fixtures to {args.output}")
+    else:
+        if args.fixtures.endswith(".jsonl"):
+            fixtures = Fixtures().load(args.fixtures)
+        else:
+            fixtures = Fixtures().load_cache(args.fixtures)
+        server = serve(fixtures, args.port, args.latency, args.jitter,
+                       args.error_rate, args.throttle_rate, args.verbose)
+        print(f"Serving {len(fixtures.metadata)} panos on {server.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,92 @@
+import numpy as np
+
+# Vectorized geodesy helpers. Every function takes degrees and accepts either
+# scalars or numpy arrays (broadcast against each other), returning an array
+# of the broadcast shape. Scalar callers can wrap the result in float().
+EARTH_RADIUS = 6371000  # Meters, as used by irtpanos and dist.py
+MEAN_EARTH_RADIUS = 6371008.8  # Meters, IUGG mean radius used by the haversine package
+METERS_PER_DEGREE = 100000  # Rough planar approximation used by dist.py
+
+
+def bearing(lat1, lng1, lat2, lng2):
+    """Calculates the initial bearing from point 1 to point 2.
+
+    Returns:
+        Heading in degrees in [0, 360) (0=North, 90=East, 180=South, 270=West).
+    """
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    delta_lng = np.radians(np.subtract(lng2, lng1))
+    y = np.sin(delta_lng) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(delta_lng)
+    return (np.degrees(np.arctan2(y, x)) + 360) % 360
+
+
+def destination(lat, lng, heading, distance, radius=EARTH_RADIUS):
+    """Calculates the point reached by travelling distance meters along heading.
+
+    Returns:
+        Tuple of (destination_lat, destination_lng) arrays in degrees.
+    """
+    lat = np.radians(lat)
+    lng = np.radians(lng)
+    heading = np.radians(heading)
+    distance_ratio = np.divide(distance, radius)
+
+    destination_lat = np.arcsin(
+        np.sin(lat) * np.cos(distance_ratio) +
+        np.cos(lat) * np.sin(distance_ratio) * np.cos(heading)
+    )
+    destination_lng = lng + np.arctan2(
+        np.sin(heading) * np.sin(distance_ratio) * np.cos(lat),
+        np.cos(distance_ratio) - np.sin(lat) * np.sin(destination_lat)
+    )
+    return np.degrees(destination_lat), np.degrees(destination_lng)
+
+
+def haversine_distance(lat1, lng1, lat2, lng2, radius=EARTH_RADIUS):
+    """Calculates the great-circle distance between two points, in meters."""
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlng = np.radians(np.subtract(lng2, lng1))
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2)**2
+    return radius * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def planar_distance(lat1, lng1, lat2, lng2):
+    """Calculates an approximate distance in meters, treating lat/lng as x/y."""
+    dlat = np.subtract(lat2, lat1)
+    dlng = np.subtract(lng2, lng1)
+    avg_lat = np.add(lat1, lat2) / 2
+    meters_per_lng_degree = METERS_PER_DEGREE * np.cos(np.radians(avg_lat))
+    return np.hypot(dlat * METERS_PER_DEGREE, dlng * meters_per_lng_degree)
+
+
+def heading_offset(a, b):
+    """Returns the signed turn from heading a to heading b.
+
+    For headings in [0, 360) the result is in [-180, 180].
+    """
+    offset = np.subtract(b, a)
+    return np.where(offset > 180, offset - 360, np.where(offset < -180, offset + 360, offset))
+
+
+def degree_circle(lat, lng, radius_km, num_vertices=36):
+    """Approximates a circle around a point as a closed ring of vertices.
+
+    Uses a flat 111 km per degree conversion, adjusted for latitude, which is
+    good enough for drawing coverage areas on a map.
+
+    Returns:
+        A (num_vertices + 1, 2) array of [lng, lat] pairs; the last vertex
+        repeats the first to close the ring.
+    """
+    radius_lat_deg = radius_km / 111.0  # 1 degree of latitude is approx 111 km
+    radius_lng_deg = radius_km / (111.0 * np.cos(np.radians(lat)))  # adjust for latitude
+    angles = 2 * np.pi * np.arange(num_vertices) / num_vertices
+    vertices = np.column_stack((
+        lng + radius_lng_deg * np.cos(angles),
+        lat + radius_lat_deg * np.sin(angles),
+    ))
+    return np.vstack((vertices, vertices[:1]))
@@ -0,0 +1,76 @@
+import json
+import sys
+import time
+
+# Streaming GeoJSON output for crawls and scans. Features are written out as
+# they are produced instead of being collected for one json.dump at the end,
+# so memory stays flat however large the output gets. Paths ending in one of
+# NDJSON_SUFFIXES get newline-delimited GeoJSON (one Feature per line), which
+# map tooling can read while the job is still running; anything else gets a
+# FeatureCollection whose closing brackets are written by close().
+NDJSON_SUFFIXES = (".ndjson", ".geojsonl", ".jsonl")
+FLUSH_INTERVAL = 1.0  # Seconds between flushes, so readers see recent features
+
+
+class FeatureWriter:
+    """Writes GeoJSON features to a file, or to stdout for "-", one at a time.
+
+    Args:
+        path: The file to write, or "-" for stdout.
+        ndjson: Write newline-delimited GeoJSON instead of a FeatureCollection.
+          Defaults to whether path ends in one of NDJSON_SUFFIXES.
+        indent: Indent for pretty printing FeatureCollection output; None
+          (the default) writes each feature compactly on its own line.
+        offset: Resume an earlier, unclosed file by truncating it to this
+          byte offset (from tell()) and appending from there.
+        count: The number of features already written before offset.
+    """
+
+    def __init__(self, path, ndjson=None, indent=None, offset=None, count=0):
+        self.path = path
+        self.ndjson = path.endswith(NDJSON_SUFFIXES) if ndjson is None else ndjson
+        self.indent = indent
+        self.count = count
+        if path == "-":
+            self._file = sys.stdout.buffer
+        elif offset is not None:
+            self._file = open(path, "r+b")
+            self._file.seek(offset)
+            self._file.truncate()
+        else:
+            self._file = open(path, "wb")
+        if not self.ndjson and offset is None:
+            self._file.write(b'{"type": "FeatureCollection", "features": [')
+        self._last_flush = time.monotonic()
+
+    def write(self, feature):
+        if self.ndjson:
+            text = json.dumps(feature) + "\n"
+        else:
+            text = ("," if self.count else "") + "\n" + json.dumps(feature, indent=self.indent)
+        self._file.write(text.encode("utf-8"))
+        self.count += 1
+        if time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def tell(self):
+        """Flushes and returns the byte offset to resume from after a crash."""
+        self.flush()
+        return self._file.tell()
+
+    def close(self):
+        if not self.ndjson:
+            self._file.write(b"\n]}\n")
+        self.flush()
+        if self._file is not sys.stdout.buffer:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,5 +1,5 @@
 import sys
-from haversine import haversine, Unit
+import geodesy
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Calculates the haversine distance between two points.
@@ -16,7 +16,7 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     try:
       point1 = (float(lat1), float(lon1))
       point2 = (float(lat2), float(lon2))
-      distance = haversine(point1, point2, unit=Unit.METERS)
+      distance = float(geodesy.haversine_distance(*point1, *point2, radius=geodesy.MEAN_EARTH_RADIUS))
       return distance
     except ValueError:
       print("Invalid input: coordinates must be numbers.")
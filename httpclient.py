@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+import requests
+import metrics
+import ratelimit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared HTTP client for every script that talks to the Tile API or a
+# third-party service. Connections are kept alive and pooled per host, so
+# repeat calls skip the TCP and TLS handshake.
+TIMEOUT = (5, 30)  # (connect, read) seconds, used when a call passes none
+POOL_CONNECTIONS = 10  # Number of distinct hosts to keep pools for
+POOL_MAXSIZE = 16  # Default open connections per host
+# Per-host pool sizes; requests beyond the limit wait for a free connection.
+HOST_POOL_SIZES = {
+    "tile.googleapis.com": 64,
+    "radio.garden": 8,
+    "roadtrip.pikarocks.dev": 4,
+}
+RETRIES = 3
+BACKOFF_FACTOR = 0.5  # Sleeps 0.5s, 1s, 2s, ... between retries
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Base URL for the Street View Tile API. Point it at a local fakeapi.py
+# server to run against recorded fixtures instead of the real API.
+DEFAULT_TILE_API_URL = "https://tile.googleapis.com"
+TILE_API_URL = os.environ.get("TILE_API_URL", DEFAULT_TILE_API_URL)
+
+
+def configure(base_url=None):
+    """Points this process at another Tile API base URL; None restores the default.
+
+    Takes effect for every call made afterwards, whenever the calling
+    modules were imported.
+    """
+    global TILE_API_URL
+    TILE_API_URL = base_url or os.environ.get("TILE_API_URL", DEFAULT_TILE_API_URL)
+
+
+def tile_api_url(method):
+    """Returns the URL of a Street View Tile API method, e.g. tile_api_url("metadata")."""
+    return f"{TILE_API_URL}/v1/streetview/{method}"
+
+
+def api_scope():
+    """Returns the prefix for cache keys of Tile API answers.
+
+    Empty for the real API; answers from any other base URL (a fakeapi
+    server, say) are kept apart under "@<base URL> ", so they never mix
+    with real ones in the shared cache and pano index.
+    """
+    return "" if TILE_API_URL == DEFAULT_TILE_API_URL else "@%s " % TILE_API_URL
+
+class TimeoutSession(requests.Session):
+    """A requests Session that applies TIMEOUT to calls that don't set one.
+
+    Every call is paced by the ratelimit limiter for its endpoint and
+    recorded in the API metrics.
+    """
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", TIMEOUT)
+        endpoint = ratelimit.endpoint_for(url)
+        with ratelimit.limiter_for(url).request() as record_status:
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                metrics.api_requests.inc(endpoint=endpoint, status="error")
+                raise
+            finally:
+                metrics.api_request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+            metrics.api_requests.inc(endpoint=endpoint, status=response.status_code)
+            record_status(response.status_code)
+        return response
+
+
+class ThrottleRetry(Retry):
+    """Retry policy that also reports throttled attempts to the rate limiter.
+
+    Retries happen inside urllib3, so without this the limiter would only see
+    the final response and never the 429s that preceded it.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and response.status in ratelimit.THROTTLE_STATUSES and _pool is not None:
+            ratelimit.limiter_for(f"{_pool.scheme}://{_pool.host}{url or ''}").concurrency.throttle()
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def make_adapter(pool_maxsize):
+    """Builds an adapter with a keep-alive pool and retry/backoff policy.
+
+    Retries cover connection errors and RETRY_STATUSES, honouring any
+    Retry-After header. Once retries run out the last response is returned
+    as-is so callers can still inspect it or call raise_for_status().
+    """
+    retry = ThrottleRetry(
+        total=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        # panoIds lookups are POSTs but safe to repeat.
+        allowed_methods=frozenset(["GET", "HEAD", "POST"]),
+        raise_on_status=False,
+    )
+    return HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+        max_retries=retry,
+    )
+
+
+def make_session():
+    """Creates a new pooled session configured from the module settings."""
+    session = TimeoutSession()
+    default_adapter = make_adapter(POOL_MAXSIZE)
+    session.mount("https://", default_adapter)
+    session.mount("http://", default_adapter)
+    for host, pool_maxsize in HOST_POOL_SIZES.items():
+        session.mount(f"https://{host}/", make_adapter(pool_maxsize))
+    return session
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """Returns the process-wide session, creating it on first use."""
+    global _session, _session_pid
+    # Pooled sockets must not be shared across a fork.
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = make_session()
+            _session_pid = os.getpid()
+    return _session
+
+
+def get(url, **kwargs):
+    """Same as requests.get, over the shared session."""
+    return session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Same as requests.post, over the shared session."""
+    return session().post(url, **kwargs)
@@ -1,14 +1,27 @@
+import concurrent.futures
 import json
-import math
 import sys
-import requests
-import haversine
+import httpclient
+import numpy as np
+import geodesy
 import keys
+import metrics
+import panocache
+import panoindex
+import singleflight
 
 # https://console.cloud.google.com/google/maps-apis/credentials
 API_KEY = keys.API_KEY
 # curl -X POST https://tile.googleapis.com/v1/createSession?mapType=streetview&key=API_KEY
 SESSION_KEY = keys.SESSION_KEY
+# Candidate pano metadata for a stop is fetched concurrently on this pool.
+METADATA_WORKERS = 8
+metadata_pool = concurrent.futures.ThreadPoolExecutor(max_workers=METADATA_WORKERS)
+# The panoIds endpoint accepts at most this many locations per request.
+MAX_PANO_ID_LOCATIONS = 100
+# Concurrent lookups of the same pano or the same panoIds request share one call.
+metadata_flight = singleflight.Group()
+pano_ids_flight = singleflight.Group()
 
 def main(pano, heading, search_dist=13):
     #print("hi")
@@ -18,30 +31,132 @@ def main(pano, heading, search_dist=13):
         print(f"  {json.dumps(option)}")
 
 
+@metrics.timed("predict_options")
 def predict_options(cur_pano_id: str, cur_heading: float, search_dist: float = 13, lat=None, lng=None):
     cur_lat = lat
     cur_lng = lng
-    metadata = get_metadata(cur_pano_id)
-    if not cur_lat:
-      #if 
-      #cur_lat = metadata.get("lat", 0)# or metadata["originalLat"]
-      #cur_lng = metadata.get("lng", 0)# or metadata["originalLng"]
-      if cur_pano_id.startswith("CAoSF"):
-        cur_lat = metadata.get("lat",0)# or metadata.get("lat",0)
-        cur_lng = metadata.get("lng",0)# or metadata.get("lng",0)
-      else:
-        cur_lat = metadata.get("originalLat") or metadata.get("lat",0)
-        cur_lng = metadata.get("originalLng") or metadata.get("lng",0)
+    if cur_lat:
+      # The location is already known, so the panoIds lookup below can run
+      # while the current pano's links are still being fetched.
+      metadata_future = metadata_pool.submit(get_metadata, cur_pano_id)
+    else:
+      metadata_future = None
+      metadata = get_metadata(cur_pano_id)
+      cur_lat, cur_lng = pano_location(cur_pano_id, metadata)
+
+    locations = offset_locations(cur_lat, cur_lng, cur_heading, search_dist)
+    #print(locations)
+
+    extra_pano_ids = get_pano_ids(locations, 50)
+    #print(extra_pano_ids)
+
+    if metadata_future is not None:
+      metadata = metadata_future.result()
+
+    candidate_pano_ids = candidate_options(cur_pano_id, metadata, extra_pano_ids)
+    # Fetch every candidate at once, then filter in the original order so the
+    # heading checks see candidates exactly as the sequential loop did.
+    candidate_metadata = dict(zip(candidate_pano_ids, metadata_pool.map(get_metadata, candidate_pano_ids)))
+    return filter_options(cur_pano_id, cur_heading, cur_lat, cur_lng, metadata, candidate_pano_ids, candidate_metadata)
+
+
+@metrics.timed("predict_options_many")
+def predict_options_many(stops: list, search_dist: float = 13) -> list[list[dict]]:
+    """Predicts options for many stops at once.
+
+    The offset locations of every stop are packed into as few panoIds requests
+    as the API allows, and each pano's metadata is fetched only once no matter
+    how many stops it shows up in.
+
+    Args:
+        stops: A list of (pano_id, heading) tuples.
+        search_dist: Distance in meters to the offset search points.
+
+    Returns:
+        A list with the predict_options result for each stop, in input order,
+        or None for a stop whose panoIds lookup failed.
+    """
+    stop_pano_ids = list(dict.fromkeys(pano_id for pano_id, _ in stops))
+    metadata_by_pano = dict(zip(stop_pano_ids, metadata_pool.map(get_metadata, stop_pano_ids)))
+
+    stop_locations = []
+    location_groups = []
+    for pano_id, heading in stops:
+        cur_lat, cur_lng = pano_location(pano_id, metadata_by_pano[pano_id])
+        stop_locations.append((cur_lat, cur_lng))
+        location_groups.append(offset_locations(cur_lat, cur_lng, heading, search_dist))
+    extra_pano_ids_per_stop = get_pano_ids_many(location_groups, 50)
+
+    candidates_per_stop = []
+    for (pano_id, _), extra_pano_ids in zip(stops, extra_pano_ids_per_stop):
+        if extra_pano_ids is None:
+            candidates_per_stop.append(None)
+            continue
+        candidates_per_stop.append(candidate_options(pano_id, metadata_by_pano[pano_id], extra_pano_ids))
+    missing = list(dict.fromkeys(
+        option_pano_id
+        for candidates in candidates_per_stop if candidates is not None
+        for option_pano_id in candidates
+        if option_pano_id not in metadata_by_pano
+    ))
+    metadata_by_pano.update(zip(missing, metadata_pool.map(get_metadata, missing)))
 
     predicted = []
+    for (pano_id, heading), (cur_lat, cur_lng), candidates in zip(stops, stop_locations, candidates_per_stop):
+        if candidates is None:
+            predicted.append(None)
+            continue
+        predicted.append(filter_options(
+            pano_id, heading, cur_lat, cur_lng, metadata_by_pano[pano_id], candidates, metadata_by_pano))
+    return predicted
+
+
+def pano_location(pano_id: str, metadata: dict) -> tuple[float, float]:
+    #cur_lat = metadata.get("lat", 0)# or metadata["originalLat"]
+    #cur_lng = metadata.get("lng", 0)# or metadata["originalLng"]
+    if pano_id.startswith("CAoSF"):
+      return metadata.get("lat",0), metadata.get("lng",0)# or metadata.get("lat",0)
+    return (metadata.get("originalLat") or metadata.get("lat",0),
+            metadata.get("originalLng") or metadata.get("lng",0))
+
+
+def offset_locations(cur_lat: float, cur_lng: float, cur_heading: float, search_dist: float) -> list[tuple[float, float]]:
+    heading_offsets = np.array((0, -45, 45, 90, -90))
+
+#    print (cur_lat, cur_lng)
+    lats, lngs = geodesy.destination(
+        cur_lat,
+        cur_lng,
+        normalize_heading(cur_heading) + heading_offsets,
+        search_dist,
+        radius=geodesy.MEAN_EARTH_RADIUS,
+    )
+    return list(zip(lats.tolist(), lngs.tolist()))
+
+
+def candidate_options(cur_pano_id: str, metadata: dict, extra_pano_ids: list[str]) -> list[str]:
+    """Returns the panoIds results that still need metadata, in order."""
     seen_pano_ids = set()
     seen_pano_ids.add(cur_pano_id)
+    for link in metadata.get("links") or []:
+        seen_pano_ids.add(link["panoId"])
+
+    candidate_pano_ids = []
+    for option_pano_id in extra_pano_ids:
+        if not option_pano_id or option_pano_id in seen_pano_ids:
+            continue
+        seen_pano_ids.add(option_pano_id)
+        candidate_pano_ids.append(option_pano_id)
+    return candidate_pano_ids
+
+
+def filter_options(cur_pano_id, cur_heading, cur_lat, cur_lng, metadata, candidate_pano_ids, metadata_by_pano):
+    predicted = []
     seen_headings = []
 
     checked_count = 0
 
     for link in metadata.get("links") or []:
-        seen_pano_ids.add(link["panoId"])
         heading_offset = calculate_heading_offset(cur_heading, link["heading"])
         checked_count += 1
         if abs(heading_offset) < 100:
@@ -57,46 +172,22 @@ def predict_options(cur_pano_id: str, cur_heading: float, search_dist: float = 1
             predicted.append(data)
             seen_headings.append(link["heading"])
 
-    heading_offsets = (0, -45, 45, 90, -90)
-
-#    print (cur_lat, cur_lng)
-    locations = []
-    for heading_offset in heading_offsets:
-        locations.append(
-            haversine.inverse_haversine(
-                (cur_lat, cur_lng),
-                search_dist,
-                math.radians(normalize_heading(cur_heading) + heading_offset),
-                unit=haversine.Unit.METERS,
-            )
-        )
-
-    #print(locations)
-
-    extra_pano_ids = get_pano_ids(locations, 50)
-    #print(extra_pano_ids)
-    for option_pano_id in extra_pano_ids:
-        if not option_pano_id or option_pano_id in seen_pano_ids:
-            continue
-        seen_pano_ids.add(option_pano_id)
-
-        option_metadata = get_metadata(option_pano_id)
-
-        if option_pano_id.startswith("CAoSF"):
-          option_lat = option_metadata.get("lat",0)# or option_metadata.get("lat",0)
-          option_lng = option_metadata.get("lng",0)# or option_metadata.get("lng",0)
-        else:
-          option_lat = option_metadata.get("originalLat") or option_metadata.get("lat",0)
-          option_lng = option_metadata.get("originalLng") or option_metadata.get("lng",0)
-
+    option_locations = []
+    for option_pano_id in candidate_pano_ids:
+        option_metadata = metadata_by_pano[option_pano_id]
+        option_lat, option_lng = pano_location(option_pano_id, option_metadata)
         if not option_lat:
           print("Invalid pano location? Stop: %s Pano: %s \n %s" % (cur_pano_id, option_pano_id, option_metadata))
+        option_locations.append((option_lat, option_lng))
 
-        option_heading = calculate_heading(
-            (cur_lat, cur_lng),
-            (option_lat, option_lng),
-        )
-        heading_offset = calculate_heading_offset(cur_heading, option_heading)
+    # Headings and offsets for every candidate in one pass.
+    option_lats, option_lngs = np.array(option_locations, dtype=float).reshape(-1, 2).T
+    option_headings = geodesy.bearing(cur_lat, cur_lng, option_lats, option_lngs)
+    heading_offsets = geodesy.heading_offset(cur_heading, option_headings)
+
+    for option_pano_id, option_heading, heading_offset in zip(
+            candidate_pano_ids, option_headings.tolist(), heading_offsets.tolist()):
+        option_metadata = metadata_by_pano[option_pano_id]
         if abs(heading_offset) > 100:
             #print("Pano %s in wrong direction, %s" % (option_pano_id, heading_offset))
             continue
@@ -104,7 +195,6 @@ def predict_options(cur_pano_id: str, cur_heading: float, search_dist: float = 1
         # filter if the heading is too close to another heading
         too_close_to_other_heading = False
         for seen_heading in seen_headings:
-            calculate_heading_offset(seen_heading, option_heading)
             if abs(calculate_heading_offset(seen_heading, option_heading)) < 15:
                 too_close_to_other_heading = True
                 #print("Pano %s heading %s too close to %s, %s, %s" % (option_pano_id, option_heading, seen_heading, option_lat, option_lng))
@@ -127,7 +217,7 @@ def predict_options(cur_pano_id: str, cur_heading: float, search_dist: float = 1
 
 
 def calculate_heading_offset(a: float, b: float) -> float:
-    return normalize_heading(b - a)
+    return float(geodesy.heading_offset(a, b))
 
 
 def normalize_heading(heading: float) -> float:
@@ -138,20 +228,124 @@ def normalize_heading(heading: float) -> float:
     return heading
 
 
+@metrics.timed("get_metadata")
 def get_metadata(pano_id: str) -> dict:
-    res = requests.get(
-        f"https://tile.googleapis.com/v1/streetview/metadata?session={SESSION_KEY}&key={API_KEY}&panoId={pano_id}"
+    cached = panocache.get_metadata(pano_id)
+    if cached is not None:
+        return cached
+    return metadata_flight.do(pano_id, fetch_metadata, pano_id)
+
+
+def fetch_metadata(pano_id: str) -> dict:
+    res = httpclient.get(
+        f"{httpclient.tile_api_url('metadata')}?session={SESSION_KEY}&key={API_KEY}&panoId={pano_id}"
     )
     data = res.json()
     if not 'lat' in data:
       print("Broken metadata? %s: \n %s" % (pano_id, data))
+    else:
+      panocache.put_metadata(pano_id, data)
     return data
 
 
+@metrics.timed("get_pano_ids")
 def get_pano_ids(locations: list, radius: float) -> list[str]:
     requesting_locations = [{"lat": loc[0], "lng": loc[1]} for loc in locations]
-    res = requests.post(
-        f"https://tile.googleapis.com/v1/streetview/panoIds?session={SESSION_KEY}&key={API_KEY}",
+    cached = panocache.get_pano_ids(requesting_locations, radius)
+    if cached is not None:
+        return cached
+    offline = panoindex.lookup(requesting_locations, radius)
+    if offline is not None:
+        return offline
+    pano_ids = request_pano_ids(requesting_locations, radius)
+    panocache.put_pano_ids(requesting_locations, radius, pano_ids)
+    panoindex.record(requesting_locations, radius, pano_ids)
+    return pano_ids
+
+
+def get_pano_ids_many(location_groups: list, radius: float) -> list[list[str]]:
+    """Looks up panoIds for many groups of locations with as few requests as possible.
+
+    Groups that are not already cached or answered by the local pano index
+    are flattened into a single list of
+    locations and sent MAX_PANO_ID_LOCATIONS at a time; the positional results
+    are then split back into one list per group.
+
+    Args:
+        location_groups: A list of location lists, as passed to get_pano_ids.
+        radius: The search radius in meters.
+
+    A chunk whose request fails only holds up the groups with locations in
+    it; each of those is then looked up with a request of its own.
+
+    Returns:
+        A list of panoIds results, one per group, with None for a group whose
+        own lookup failed too.
+    """
+    results = [None] * len(location_groups)
+    pending = []
+    for i, locations in enumerate(location_groups):
+        requesting_locations = [{"lat": loc[0], "lng": loc[1]} for loc in locations]
+        cached = panocache.get_pano_ids(requesting_locations, radius)
+        if cached is None:
+            cached = panoindex.lookup(requesting_locations, radius)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.append((i, requesting_locations))
+
+    flat_locations = [loc for _, requesting_locations in pending for loc in requesting_locations]
+    chunks = [flat_locations[start:start + MAX_PANO_ID_LOCATIONS]
+              for start in range(0, len(flat_locations), MAX_PANO_ID_LOCATIONS)]
+    flat_pano_ids = []
+    failed_chunks = set()
+    for index, (chunk, pano_ids) in enumerate(zip(chunks, metadata_pool.map(
+            lambda chunk: try_request_pano_ids(chunk, radius), chunks))):
+        if pano_ids is None:
+            failed_chunks.add(index)
+            pano_ids = [None] * len(chunk)
+        flat_pano_ids.extend(pano_ids)
+
+    offset = 0
+    retry = []
+    for i, requesting_locations in pending:
+        first_chunk = offset // MAX_PANO_ID_LOCATIONS
+        last_chunk = (offset + len(requesting_locations) - 1) // MAX_PANO_ID_LOCATIONS
+        if failed_chunks.intersection(range(first_chunk, last_chunk + 1)):
+            retry.append((i, requesting_locations))
+        else:
+            results[i] = flat_pano_ids[offset:offset + len(requesting_locations)]
+        offset += len(requesting_locations)
+    if retry:
+        print("Retrying %d stops from failed panoIds requests one at a time" % len(retry))
+        for (i, requesting_locations), pano_ids in zip(retry, metadata_pool.map(
+                lambda group: try_request_pano_ids(group[1], radius), retry)):
+            results[i] = pano_ids
+
+    for i, requesting_locations in pending:
+        if results[i] is not None:
+            panocache.put_pano_ids(requesting_locations, radius, results[i])
+            panoindex.record(requesting_locations, radius, results[i])
+    return results
+
+
+def request_pano_ids(requesting_locations: list[dict], radius: float) -> list[str]:
+    key = panocache.pano_ids_key(requesting_locations, radius)
+    return pano_ids_flight.do(key, post_pano_ids, requesting_locations, radius)
+
+
+def try_request_pano_ids(requesting_locations: list[dict], radius: float) -> list[str]:
+    """Same as request_pano_ids, but reports a failed request and returns None."""
+    try:
+        return request_pano_ids(requesting_locations, radius)
+    except Exception as e:
+        print("panoIds request for %d locations failed: %r" % (len(requesting_locations), e))
+        return None
+
+
+def post_pano_ids(requesting_locations: list[dict], radius: float) -> list[str]:
+    res = httpclient.post(
+        f"{httpclient.tile_api_url('panoIds')}?session={SESSION_KEY}&key={API_KEY}",
         json={"locations": requesting_locations, "radius": radius},
     )
     data = res.json()
@@ -161,17 +355,7 @@ def get_pano_ids(locations: list, radius: float) -> list[str]:
 
 
 def calculate_heading(start: tuple[float, float], end: tuple[float, float]) -> float:
-    # based on https://gist.github.com/jeromer/2005586
-    lat1 = math.radians(start[0])
-    lat2 = math.radians(end[0])
-    diff_lng = math.radians(end[1] - start[1])
-    x = math.sin(diff_lng) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - (
-        math.sin(lat1) * math.cos(lat2) * math.cos(diff_lng)
-    )
-    initial_bearing = math.atan2(x, y)
-    initial_bearing = math.degrees(initial_bearing)
-    return (initial_bearing + 360) % 360
+    return float(geodesy.bearing(start[0], start[1], end[0], end[1]))
 
 
 if __name__ == "__main__":
@@ -1,8 +1,14 @@
 import requests
-import math
+import httpclient
+import numpy as np
+import geodesy
 import json
 import sys
 import keys
+import panocache
+import panograph
+import panoindex
+import singleflight
 
 def calculate_heading(lat1, lon1, lat2, lon2):
     """
@@ -16,25 +22,15 @@ def calculate_heading(lat1, lon1, lat2, lon2):
         Heading in degrees (0=North, 90=East, 180=South, 270=West).
     """
 #    print("calculate_heading: %f, %f, %f, %f" % (lat1, lon1, lat2, lon2))
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-
-    delta_lon = lon2_rad - lon1_rad
-    y = math.sin(delta_lon) * math.cos(lat2_rad)
-    x = math.cos(lat1_rad) * math.sin(lat2_rad) - \
-        math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(delta_lon)
-    heading_rad = math.atan2(y, x)
-    heading_deg = math.degrees(heading_rad)
-    return (heading_deg + 360) % 360
+    return float(geodesy.bearing(lat1, lon1, lat2, lon2))
 # API Constants
-API_URL = "https://tile.googleapis.com/v1/streetview/panoIds"
-METADATA_API_URL = "https://tile.googleapis.com/v1/streetview/metadata"
 SESSION_KEY = keys.SESSION_KEY
 API_KEY = keys.API_KEY
 RADIUS = 20 # Radius for PanoID search in meters
 OFFSET_DISTANCE = 15 # Distance forward in meters
+# Concurrent lookups of the same pano or the same locations share one request.
+metadata_flight = singleflight.Group()
+pano_ids_flight = singleflight.Group()
 
 def inverse_haversine(lat, lon, heading, distance):
     """
@@ -47,22 +43,8 @@ def inverse_haversine(lat, lon, heading, distance):
     Returns:
         Tuple of (destination_lat, destination_lon) in degrees.
     """
-    R = 6371000  # Earth radius in meters
-    lat_rad = math.radians(lat)
-    lon_rad = math.radians(lon)
-    heading_rad = math.radians(heading)
-    distance_ratio = distance / R
-
-    destination_lat_rad = math.asin(
-        math.sin(lat_rad) * math.cos(distance_ratio) +
-        math.cos(lat_rad) * math.sin(distance_ratio) * math.cos(heading_rad)
-    )
-    destination_lon_rad = lon_rad + math.atan2(
-        math.sin(heading_rad) * math.sin(distance_ratio) * math.cos(lat_rad),
-        math.cos(distance_ratio) - math.sin(lat_rad) * math.sin(destination_lat_rad)
-    )
-
-    return math.degrees(destination_lat_rad), math.degrees(destination_lon_rad)
+    destination_lat, destination_lon = geodesy.destination(lat, lon, heading, distance)
+    return float(destination_lat), float(destination_lon)
 
 def get_pano_ids(locations):
     """
@@ -80,11 +62,30 @@ def get_pano_ids(locations):
         "locations": locations,
         "radius": RADIUS
     }
+    cached = panocache.get_pano_ids(locations, RADIUS)
+    if cached is not None:
+        return list(set([pano_id for pano_id in cached if pano_id != '']))
+    offline = panoindex.lookup(locations, RADIUS)
+    if offline is not None:
+        return list(set([pano_id for pano_id in offline if pano_id != '']))
+    return pano_ids_flight.do(panocache.pano_ids_key(locations, RADIUS), post_pano_ids, params, payload)
+
+def post_pano_ids(params, payload):
+    """
+    Sends a PanoIDs API request, bypassing the cache.
+    Args:
+        params: The query parameters, with session and key.
+        payload: The request body, with locations and radius.
+    Returns:
+        A list of PanoIDs, or None if the request fails.
+    """
+    locations = payload["locations"]
     try:
-        r = requests.post(API_URL, params=params, headers={'Content-Type': 'application/json'}, data=json.dumps(payload))
+        r = httpclient.post(httpclient.tile_api_url("panoIds"), params=params, headers={'Content-Type': 'application/json'}, data=json.dumps(payload))
         r.raise_for_status()
         data = r.json()
-        
+        panocache.put_pano_ids(locations, RADIUS, data.get("panoIds"))
+        panoindex.record(locations, RADIUS, data.get("panoIds"))
         return list(set([pano_id for pano_id in data.get("panoIds") if pano_id != '']))
     except requests.exceptions.RequestException as e:
         print(e.response)
@@ -99,15 +100,29 @@ def get_pano_metadata(pano_id):
     Returns:
         The metadata dictionary, or None if the request fails.
     """
+    cached = panocache.get_metadata(pano_id)
+    if cached is not None:
+        return cached
+    return metadata_flight.do(pano_id, fetch_pano_metadata, pano_id)
+
+def fetch_pano_metadata(pano_id):
+    """
+    Fetches metadata for a PanoID from the API, bypassing the cache.
+    Args:
+        pano_id: The PanoID to fetch metadata for.
+    Returns:
+        The metadata dictionary, or None if the request fails.
+    """
     params = {
         "session": SESSION_KEY,
         "key": API_KEY,
         "panoId": pano_id
     }
     try:
-        r = requests.get(METADATA_API_URL, params=params)
+        r = httpclient.get(httpclient.tile_api_url("metadata"), params=params)
         r.raise_for_status() 
         data = r.json()
+        panocache.put_metadata(pano_id, data)
         return data
     except requests.exceptions.RequestException as e:
         print(f"Error fetching metadata for pano {pano_id}: {e}")
@@ -133,14 +148,15 @@ def safe_heading(start_heading, heading):
 
 
 def get_second(pano_id, start_pano):
-  data = get_pano_metadata(pano_id)
+  links = panograph.get_links(pano_id)
+  if links is None:
+    data = get_pano_metadata(pano_id)
+    links = [(link.get("panoId"), link.get("heading")) for link in data.get("links") or []]
   options = []
-  if data.get("links"):
-    for link in data.get("links"):
-      
-      if link.get("panoId") == start_pano:
-        continue
-      options.append(link.get("panoId"))
+  for link_id, _ in links:
+    if link_id == start_pano:
+      continue
+    options.append(link_id)
   if len(options) > 1:
     return []
   if len(options) == 0:
@@ -179,9 +195,8 @@ def repro_irt(start_pano_id, start_heading, start_lat=None, start_lon=None):
           pano_headings[linked_pano_id] = linked_pano_heading
     # Define the angles for the forward locations
     angles = [0, -45, 45, 90, -90]
-    for angle in angles:
-        new_heading = start_heading + angle
-        new_lat, new_lon = inverse_haversine(start_lat, start_lon, new_heading, OFFSET_DISTANCE)
+    new_lats, new_lons = geodesy.destination(start_lat, start_lon, start_heading + np.array(angles), OFFSET_DISTANCE)
+    for new_lat, new_lon in zip(new_lats.tolist(), new_lons.tolist()):
         locations.append({"lat": new_lat, "lng": new_lon})
     # Make the PanoID API request
     pano_ids_per_angle = get_pano_ids(locations)
@@ -221,6 +236,7 @@ def repro_irt(start_pano_id, start_heading, start_lat=None, start_lon=None):
       print("There is only one option")
       skip = get_second(allowed_options[0][0], start_pano_id)
       print("Would (maybe?) skip to: %s" % skip)
+    return allowed_options
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
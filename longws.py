@@ -7,114 +7,190 @@ from google.cloud import bigquery
 from google.oauth2 import service_account
 import uuid
 import logging
+import re
+import sys
+import lookahead
+import metrics
+import bqwriter
+import parquetsink
+import pipeline
 
 logging.basicConfig(level=logging.INFO)
 
 PROJECT_ID = "internet-road-trip"  # Replace with your Google Cloud project ID
 DATASET_ID = "irt"  # Replace with your BigQuery dataset ID
 TABLE_ID = "stops"  # Replace with your BigQuery table ID
+PARSE_QUEUE_SIZE = 1000  # Raw messages waiting to be parsed before the oldest are dropped
+SINK_QUEUE_SIZE = 100  # New stops waiting to be stored before parsing blocks
+SINK_WORKERS = 2  # Threads shaping and spooling stop rows
 
 stop = 0
+# The last raw message seen; only parsed again if something needs it.
 prev = None
-credentials = service_account.Credentials.from_service_account_file(
-    './key.json',
-    scopes=["https://www.googleapis.com/auth/cloud-platform"],
-)
-
-# Initialize BigQuery client
-client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
-dataset_ref = client.dataset(DATASET_ID)
-table_ref = dataset_ref.table(TABLE_ID)
-table = client.get_table(table_ref) if client.get_table(table_ref) else None
-
-if not table:
-    logging.info(f"Table {TABLE_ID} not found, creating it...")
-    schema = [
-        bigquery.SchemaField("id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("raw_json", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("stop", "INTEGER", mode="NULLABLE"),
-        bigquery.SchemaField("location", "RECORD", mode="NULLABLE", fields=[
-            bigquery.SchemaField("road", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("state", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("county", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("country", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("neighborhood", "STRING", mode="NULLABLE"),
-        ]),
-        bigquery.SchemaField("voteCounts", "RECORD", mode="REPEATED", fields=[
-            bigquery.SchemaField("key", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("value", "INTEGER", mode="REQUIRED"),
-        ]),
-        bigquery.SchemaField("pano", "STRING", mode="NULLABLE"),
-        bigquery.SchemaField("heading", "FLOAT", mode="NULLABLE"),
-        bigquery.SchemaField("options", "RECORD", mode="REPEATED", fields=[
+# Finds the stop number without decoding the whole message. Most messages are
+# vote count updates within the current stop, which only need this. It is
+# only trusted when the message has a single "stop" key, which must then be
+# the top-level one; anything else is decoded in full.
+STOP_PATTERN = re.compile(r'"stop"\s*:\s*(-?\d+)')
+# Set by --lookahead; speculatively predicts options for upcoming stops.
+predictor = None
+
+def open_table():
+    """Connects to BigQuery and returns (client, table), creating the table if needed."""
+    credentials = service_account.Credentials.from_service_account_file(
+        './key.json',
+        scopes=["https://www.googleapis.com/auth/cloud-platform"],
+    )
+
+    # Initialize BigQuery client
+    client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
+    dataset_ref = client.dataset(DATASET_ID)
+    table_ref = dataset_ref.table(TABLE_ID)
+    table = client.get_table(table_ref) if client.get_table(table_ref) else None
+
+    if not table:
+        logging.info(f"Table {TABLE_ID} not found, creating it...")
+        schema = [
+            bigquery.SchemaField("id", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("raw_json", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("stop", "INTEGER", mode="NULLABLE"),
+            bigquery.SchemaField("location", "RECORD", mode="NULLABLE", fields=[
+                bigquery.SchemaField("road", "STRING", mode="NULLABLE"),
+                bigquery.SchemaField("state", "STRING", mode="NULLABLE"),
+                bigquery.SchemaField("county", "STRING", mode="NULLABLE"),
+                bigquery.SchemaField("country", "STRING", mode="NULLABLE"),
+                bigquery.SchemaField("neighborhood", "STRING", mode="NULLABLE"),
+            ]),
+            bigquery.SchemaField("voteCounts", "RECORD", mode="REPEATED", fields=[
+                bigquery.SchemaField("key", "STRING", mode="REQUIRED"),
+                bigquery.SchemaField("value", "INTEGER", mode="REQUIRED"),
+            ]),
             bigquery.SchemaField("pano", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("description", "STRING", mode="NULLABLE"),
             bigquery.SchemaField("heading", "FLOAT", mode="NULLABLE"),
+            bigquery.SchemaField("options", "RECORD", mode="REPEATED", fields=[
+                bigquery.SchemaField("pano", "STRING", mode="NULLABLE"),
+                bigquery.SchemaField("description", "STRING", mode="NULLABLE"),
+                bigquery.SchemaField("heading", "FLOAT", mode="NULLABLE"),
+                bigquery.SchemaField("lat", "FLOAT", mode="NULLABLE"),
+                bigquery.SchemaField("lng", "FLOAT", mode="NULLABLE"),
+                    ]),
+            bigquery.SchemaField("endTime", "INTEGER", mode="NULLABLE"),
             bigquery.SchemaField("lat", "FLOAT", mode="NULLABLE"),
             bigquery.SchemaField("lng", "FLOAT", mode="NULLABLE"),
-                ]),
-        bigquery.SchemaField("endTime", "INTEGER", mode="NULLABLE"),
-        bigquery.SchemaField("lat", "FLOAT", mode="NULLABLE"),
-        bigquery.SchemaField("lng", "FLOAT", mode="NULLABLE"),
-        bigquery.SchemaField("totalUsers", "STRING", mode="NULLABLE"),
-        bigquery.SchemaField("distance", "FLOAT", mode="NULLABLE"),
-        bigquery.SchemaField("chosen", "INTEGER", mode="NULLABLE"),
-        bigquery.SchemaField("station", "RECORD", mode="NULLABLE", fields=[
-            bigquery.SchemaField("name", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("url", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("distance", "INTEGER", mode="NULLABLE"),
-        ]),
-        bigquery.SchemaField("nowPlaying", "STRING", mode="NULLABLE"),
-    ]
-    table = bigquery.Table(table_ref, schema=schema)
-    table = client.create_table(table)
-    logging.info(f"Table {TABLE_ID} created.")
-else:
-    logging.info(f"Table {TABLE_ID} found.")
+            bigquery.SchemaField("totalUsers", "STRING", mode="NULLABLE"),
+            bigquery.SchemaField("distance", "FLOAT", mode="NULLABLE"),
+            bigquery.SchemaField("chosen", "INTEGER", mode="NULLABLE"),
+            bigquery.SchemaField("station", "RECORD", mode="NULLABLE", fields=[
+                bigquery.SchemaField("name", "STRING", mode="NULLABLE"),
+                bigquery.SchemaField("url", "STRING", mode="NULLABLE"),
+                bigquery.SchemaField("distance", "INTEGER", mode="NULLABLE"),
+            ]),
+            bigquery.SchemaField("nowPlaying", "STRING", mode="NULLABLE"),
+        ]
+        table = bigquery.Table(table_ref, schema=schema)
+        table = client.create_table(table)
+        logging.info(f"Table {TABLE_ID} created.")
+    else:
+        logging.info(f"Table {TABLE_ID} found.")
+    return client, table
 
-def on_message(ws, message):
+# Where stop rows go: a bqwriter.BatchWriter, which spools rows and inserts
+# them into BigQuery in batches off the websocket thread, or with --parquet a
+# parquetsink.ParquetSink writing local day-partitioned files.
+writer = None
+
+def predict_stop(data):
+    """Reports the lookahead prediction for a new stop and looks ahead from it."""
+    if not data.get('pano') or data.get('heading') is None:
+        return
+    predicted = predictor.get(data['pano'], data['heading'], timeout=0)
+    metrics.lookahead_results.inc(result="hit" if predicted is not None else "miss")
+    if predicted is not None:
+        logging.info(f"Lookahead hit for stop {data.get('stop')}: {[option['pano'] for option in predicted]}")
+    else:
+        logging.info(f"Lookahead miss for stop {data.get('stop')}")
+    predictor.on_stop(data['pano'], data['heading'])
+
+def message_stop(message):
+    """Returns the stop number in a raw message, or None if it can't be found cheaply."""
+    matches = STOP_PATTERN.findall(message)
+    return int(matches[0]) if len(matches) == 1 else None
+
+def parse_message(message):
+    """Parse stage: tracks the current stop and returns (data, message) when it changes.
+
+    Messages within the current stop are recognised from their stop number
+    alone; a message is only fully decoded when the stop may have changed.
+    """
     global stop, prev
+    if stop and prev and message_stop(message) == stop:
+        prev = message
+        return None
     try:
+        metrics.ws_messages.inc(kind="decoded")
         data = json.loads(message)
+        boundary = None
         if not stop:
             stop = data.get('stop')
             logging.info(f"Initial stop: {stop}")
+            if predictor:
+                predict_stop(data)
         if data['stop'] != stop and prev:
+            metrics.ws_messages.inc(kind="stop")
+            if predictor:
+                predict_stop(data)
             #logging.info(f"Previous message: {prev}")
-            row_id = str(uuid.uuid4())
-            row = {
-                "id": row_id,
-                "raw_json": message,
-                "stop": data.get('stop'),
-                "location": data.get('location'),
-                "voteCounts": [],
-                "pano": data.get('pano'),
-                "heading": data.get('heading'),
-                "options": data.get('options'),
-                "endTime": data.get('endTime'),
-                "lat": data.get('lat'),
-                "lng": data.get('lng'),
-                "totalUsers": data.get('totalUsers'),
-                "distance": data.get('distance'),
-                "chosen": data.get('chosen'),
-                "station": data.get('station'),
-                "nowPlaying": data.get('nowPlaying'),
-            }
-            if data.get('voteCounts'):
-                row["voteCounts"] = [{"key": key, "value": value} for key, value in data['voteCounts'].items()]
-            errors = client.insert_rows_json(table, [row])
-            if errors:
-                logging.error(f"Failed to insert row: {errors}")
-            else:
-                logging.info(f"Inserted row with id: {row_id}")
+            boundary = (data, message)
             stop = data.get('stop')
-        prev = data
+        prev = message
+        return boundary
     except json.JSONDecodeError as e:
+        metrics.ws_errors.inc(kind="json")
         logging.error(f"Error decoding JSON: {e}")
     except Exception as e:
+        metrics.ws_errors.inc(kind="other")
         logging.error(f"An unexpected error occurred: {e}")
 
+def store_stop(boundary):
+    """Sink stage: shapes a new stop into a row and spools it for BigQuery."""
+    data, message = boundary
+    row_id = str(uuid.uuid4())
+    row = {
+        "id": row_id,
+        "raw_json": message,
+        "stop": data.get('stop'),
+        "location": data.get('location'),
+        "voteCounts": [],
+        "pano": data.get('pano'),
+        "heading": data.get('heading'),
+        "options": data.get('options'),
+        "endTime": data.get('endTime'),
+        "lat": data.get('lat'),
+        "lng": data.get('lng'),
+        "totalUsers": data.get('totalUsers'),
+        "distance": data.get('distance'),
+        "chosen": data.get('chosen'),
+        "station": data.get('station'),
+        "nowPlaying": data.get('nowPlaying'),
+    }
+    if data.get('voteCounts'):
+        row["voteCounts"] = [{"key": key, "value": value} for key, value in data['voteCounts'].items()]
+    writer.add(row)
+    logging.info(f"Queued row with id: {row_id}")
+
+# Ingest stages: the websocket callback only queues raw messages for the parse
+# stage, which must see them in order, and the parse stage hands new stops to
+# the sink. A slow sink blocks the parse stage, and once the parse queue is
+# full the callback sheds the oldest queued messages rather than wait.
+sink = pipeline.Stage("sink", store_stop, maxsize=SINK_QUEUE_SIZE, workers=SINK_WORKERS)
+parser = pipeline.Stage("parse", parse_message, maxsize=PARSE_QUEUE_SIZE, next=sink)
+
+def on_message(ws, message):
+    metrics.ws_messages.inc(kind="message")
+    parser.offer(message)
+
 def on_error(ws, error):
+    metrics.ws_errors.inc(kind="websocket")
     logging.error(error)
 
 def on_close(ws, close_status_code, close_msg):
@@ -125,6 +201,28 @@ def on_open(ws):
 
 if __name__ == "__main__":
 #    websocket.enableTrace(True)
+    if "--lookahead" in sys.argv:
+        predictor = lookahead.Lookahead()
+    if "--metrics" in sys.argv:
+        index = sys.argv.index("--metrics")
+        host, port = metrics.HOST, metrics.PORT
+        if index + 1 < len(sys.argv) and not sys.argv[index + 1].startswith("--"):
+            # --metrics PORT or HOST:PORT; ":PORT" listens on every interface.
+            address = sys.argv[index + 1]
+            if ":" in address:
+                host, _, address = address.rpartition(":")
+            port = int(address)
+        metrics.serve(port, host)
+        logging.info(f"Serving metrics on {host or '*'}:{port}")
+    if "--parquet" in sys.argv:
+        index = sys.argv.index("--parquet")
+        output_dir = parquetsink.OUTPUT_DIR
+        if index + 1 < len(sys.argv) and not sys.argv[index + 1].startswith("--"):
+            output_dir = sys.argv[index + 1]
+        writer = parquetsink.ParquetSink(output_dir)
+        logging.info(f"Writing stops to {output_dir}")
+    else:
+        writer = bqwriter.BatchWriter(*open_table())
     ws = websocket.WebSocketApp("wss://internet-roadtrip-listen-eqzms.ondigitalocean.app/",
                               on_open=on_open,
                               on_message=on_message,
@@ -134,3 +232,6 @@ if __name__ == "__main__":
     ws.run_forever(dispatcher=rel, reconnect=5)  # Set dispatcher to automatic reconnection, 5 second reconnect delay if connection closed unexpectedly
     rel.signal(2, rel.abort)  # Keyboard Interrupt
     rel.dispatch()
+    parser.join()
+    sink.join()
+    writer.close()
@@ -0,0 +1,122 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import internet_roadtrip_panos
+
+# Speculative prediction for the live stop stream. When a stop arrives its
+# options are predicted straight away, and then each predicted option is
+# itself predicted, up to DEPTH levels ahead, so that whichever option wins
+# the vote already has its prediction waiting.
+DEPTH = 2  # Levels to predict beyond the current stop
+BUDGET = 16  # Maximum predictions started per stop, including the current one
+WORKERS = 8  # Predictions running at once
+MAX_ENTRIES = 512  # Cached predictions kept across stops
+
+
+def prediction_key(pano, heading):
+    """Returns the cache key for a (pano, heading) pair.
+
+    The game reports headings as 32 bit floats, so the heading of a stop can
+    differ slightly from the option that led to it; round it off.
+    """
+    return (pano, round(float(heading), 1))
+
+
+def usable(future):
+    """Returns True unless the future failed or was skipped as stale."""
+    if not future.done():
+        return True
+    return future.exception() is None and future.result() is not None
+
+
+class Lookahead:
+    """Runs predict_options ahead of the stop stream and caches the results.
+
+    Call on_stop() for every new stop, then get() for the prediction of any
+    (pano, heading) pair. Results are futures keyed by prediction_key.
+    """
+
+    def __init__(self, depth=DEPTH, budget=BUDGET, workers=WORKERS, max_entries=MAX_ENTRIES):
+        self.depth = depth
+        self.budget = budget
+        self.max_entries = max_entries
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.RLock()
+        self._results = collections.OrderedDict()
+        self._generation = 0
+        self._started = 0
+
+    def on_stop(self, pano, heading):
+        """Starts predicting from a new stop and the options beyond it.
+
+        Speculative work queued for an earlier stop that has not started yet
+        is dropped, since that branch of the route was not taken.
+
+        Returns:
+            The future for the current stop's prediction.
+        """
+        with self._lock:
+            self._generation += 1
+            self._started = 0
+            return self._submit(pano, heading, 0, self._generation)
+
+    def get(self, pano, heading, timeout=None):
+        """Returns the predicted options for (pano, heading).
+
+        Args:
+            pano: The pano ID of the stop.
+            heading: The heading of the stop.
+            timeout: Seconds to wait for a prediction that is still running.
+              If None, waits until it finishes.
+
+        Returns:
+            The list of predicted options, or None if the pair was never
+            scheduled, failed, or did not finish within the timeout.
+        """
+        with self._lock:
+            future = self._results.get(prediction_key(pano, heading))
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        except Exception as e:
+            logging.error(f"Lookahead prediction for {pano} failed: {e}")
+            return None
+
+    def _submit(self, pano, heading, level, generation):
+        # Must be called with self._lock held.
+        key = prediction_key(pano, heading)
+        future = self._results.get(key)
+        if future is not None and usable(future):
+            self._results.move_to_end(key)
+        else:
+            if self._started >= self.budget:
+                return None
+            self._started += 1
+            future = self._executor.submit(self._predict, pano, heading, generation)
+            self._results[key] = future
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+        if level < self.depth:
+            # Runs straight away if the prediction is already cached.
+            future.add_done_callback(
+                lambda f: self._expand(f, level + 1, generation))
+        return future
+
+    def _predict(self, pano, heading, generation):
+        if generation != self._generation:
+            # Superseded by a newer stop before it started.
+            return None
+        return internet_roadtrip_panos.predict_options(pano, float(heading))
+
+    def _expand(self, future, level, generation):
+        if not usable(future):
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            for option in future.result():
+                self._submit(option["pano"], option["heading"], level, generation)
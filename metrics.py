@@ -0,0 +1,165 @@
+import bisect
+import collections
+import contextlib
+import functools
+import http.server
+import threading
+import time
+
+# Minimal Prometheus-style metrics. The prediction path, the HTTP client, the
+# cache and the websocket ingest loop record into the metrics below, and
+# long-running processes call serve() to expose them at /metrics in the
+# Prometheus text format.
+HOST = "127.0.0.1"  # Only local scrapers by default; pass host="" to listen on every interface
+PORT = 9464
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in labels)
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """A value per label set that can go up and down."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """Counts observations into cumulative buckets per label set."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._counts = {}
+        self._sums = collections.defaultdict(float)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[key] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    samples.append((self.name + "_bucket", key + (("le", le),), cumulative))
+                samples.append((self.name + "_count", key, cumulative))
+                samples.append((self.name + "_sum", key, self._sums[key]))
+        return samples
+
+
+api_requests = Counter("irt_api_requests_total", "HTTP requests by endpoint and response status.")
+api_request_seconds = Histogram("irt_api_request_seconds", "HTTP request latency by endpoint.")
+cache_lookups = Counter("irt_cache_lookups_total", "Pano cache lookups by kind and result (hit or miss).")
+function_seconds = Histogram("irt_function_seconds", "Wall-clock time of instrumented functions.")
+panoindex_checks = Counter("irt_panoindex_checks_total", "panoIds answers from the API compared with the pano index (match or mismatch).")
+ws_messages = Counter("irt_ws_messages_total", "Websocket messages received, by kind.")
+lookahead_results = Counter("irt_lookahead_results_total", "Whether a new stop's prediction was ready (hit) or not (miss).")
+ws_errors = Counter("irt_ws_errors_total", "Errors while handling websocket messages.")
+pipeline_queue_depth = Gauge("irt_pipeline_queue_depth", "Items waiting in each ingest stage's queue.")
+pipeline_lag_seconds = Histogram("irt_pipeline_lag_seconds", "Time items wait in each ingest stage's queue.")
+pipeline_dropped = Counter("irt_pipeline_dropped_total", "Items shed from a full ingest stage queue.")
+spool_pending_rows = Gauge("irt_spool_pending_rows", "Stop rows spooled and waiting to be written, by sink.")
+
+
+def timed(name):
+    """Decorator that records each call's duration in function_seconds."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with function_seconds.time(function=name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Returns every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=PORT, host=HOST):
+    """Serves /metrics on host:port from a background thread and returns the server."""
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import httpclient
+import metrics
+
+# Shared on-disk cache for Tile API responses. Every tool that looks up pano
+# metadata (internet_roadtrip_panos, irtpanos, sv.py, listpanos) goes through
+# this, so a pano fetched once by any of them is free for all of them.
+# Answers from a TILE_API_URL other than the real API's are keyed apart (see
+# httpclient.api_scope), so a fakeapi run neither reads nor pollutes them.
+CACHE_FILE = os.environ.get("PANO_CACHE_FILE", "panocache.sqlite")
+TTL = 30 * 24 * 3600  # Seconds before a cached entry is refetched
+MAX_ENTRIES = 2000000  # Oldest entries are evicted past this many rows
+EVICT_CHECK_INTERVAL = 1000  # Check the size limit every this many writes
+
+METADATA = "metadata"
+PANO_IDS = "panoIds"
+
+
+class PanoCache:
+    """SQLite-backed key/value store for Tile API responses.
+
+    Entries are stored per kind (metadata keyed by panoId, panoIds keyed by
+    the request locations and radius) and expire after ``ttl`` seconds. Once
+    the table grows past ``max_entries`` the oldest entries are dropped.
+    Safe to share between threads; each process opens its own connection.
+    """
+
+    def __init__(self, path=CACHE_FILE, ttl=TTL, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # sqlite connections must not cross a fork, so reopen in child processes.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " kind TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " data TEXT NOT NULL,"
+                " fetched_at REAL NOT NULL,"
+                " PRIMARY KEY (kind, key))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_fetched_at ON entries (fetched_at)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, kind, key):
+        """Returns the cached value for (kind, key), or None if missing or expired."""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT data, fetched_at FROM entries WHERE kind = ? AND key = ?",
+                (kind, key),
+            ).fetchone()
+            if row is None or (self.ttl and time.time() - row[1] > self.ttl):
+                self.misses += 1
+                metrics.cache_lookups.inc(kind=kind, result="miss")
+                return None
+            self.hits += 1
+        metrics.cache_lookups.inc(kind=kind, result="hit")
+        return json.loads(row[0])
+
+    def put(self, kind, key, value):
+        """Stores value under (kind, key), replacing any existing entry."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (kind, key, data, fetched_at) VALUES (?, ?, ?, ?)",
+                (kind, key, json.dumps(value), time.time()),
+            )
+            conn.commit()
+            self._writes += 1
+            if self._writes % EVICT_CHECK_INTERVAL == 0:
+                self._evict(conn)
+
+    def items(self, kind, scope=""):
+        """Yields (key, value) for every unexpired entry of a kind.
+
+        Only entries from the API scope given (see httpclient.api_scope) are
+        yielded, with the scope taken off their keys; by default those from
+        the real API.
+        """
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT key, data FROM entries WHERE kind = ? AND fetched_at >= ?",
+                (kind, time.time() - self.ttl if self.ttl else 0),
+            ).fetchall()
+        for key, data in rows:
+            if scope:
+                if key.startswith(scope):
+                    yield key[len(scope):], json.loads(data)
+            elif not key.startswith("@"):
+                yield key, json.loads(data)
+
+    def evict(self):
+        """Drops expired entries and trims the cache down to max_entries."""
+        with self._lock:
+            self._evict(self._connection())
+
+    def _evict(self, conn):
+        if self.ttl:
+            conn.execute("DELETE FROM entries WHERE fetched_at < ?", (time.time() - self.ttl,))
+        count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM entries WHERE rowid IN"
+                " (SELECT rowid FROM entries ORDER BY fetched_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        conn.commit()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """Returns the process-wide cache, or None if PANO_CACHE_FILE is empty."""
+    global _default
+    if not CACHE_FILE:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = PanoCache()
+    return _default
+
+
+def use_cache(cache):
+    """Replaces the process-wide cache, e.g. with a scratch one for a benchmark."""
+    global _default
+    with _default_lock:
+        _default = cache
+
+
+def pano_ids_key(locations, radius):
+    """Builds the cache key for a panoIds request.
+
+    Args:
+        locations: A list of dictionaries with 'lat' and 'lng' keys.
+        radius: The search radius in meters.
+    """
+    points = ",".join("%.7f:%.7f" % (loc["lat"], loc["lng"]) for loc in locations)
+    return "%s%s|%s" % (httpclient.api_scope(), radius, points)
+
+
+def get_metadata(pano_id):
+    """Returns cached metadata for pano_id, or None on a miss."""
+    cache = default_cache()
+    return cache.get(METADATA, httpclient.api_scope() + pano_id) if cache else None
+
+
+def put_metadata(pano_id, data):
+    """Caches metadata for pano_id. Responses without a location are not cached."""
+    cache = default_cache()
+    if cache and data and "lat" in data:
+        cache.put(METADATA, httpclient.api_scope() + pano_id, data)
+
+
+def get_pano_ids(locations, radius):
+    """Returns the cached panoIds response for these locations, or None on a miss."""
+    cache = default_cache()
+    return cache.get(PANO_IDS, pano_ids_key(locations, radius)) if cache else None
+
+
+def put_pano_ids(locations, radius, pano_ids):
+    """Caches the panoIds response for these locations."""
+    cache = default_cache()
+    if cache and pano_ids is not None:
+        cache.put(PANO_IDS, pano_ids_key(locations, radius), pano_ids)
@@ -0,0 +1,181 @@
+import os
+import sys
+import threading
+import numpy as np
+import panocache
+
+# Compact on-disk store of the pano link graph discovered by crawls. Pano IDs
+# are interned to integers by sorting them, so a node's integer is its rank
+# and lookups are a binary search over the packed ID bytes. Adjacency is kept
+# in CSR form: the links of node i are indices[indptr[i]:indptr[i + 1]], with
+# the matching headings alongside. Every array is a .npy file in one
+# directory and is memory-mapped on load, so millions of panos open instantly
+# and only the pages actually touched are read.
+#
+# The graph is for walking links only. It keeps positions and link headings
+# but none of the other metadata fields (date, copyright, ...), and it has no
+# expiry, so it is not a stand-in for the metadata endpoint or panocache.
+GRAPH_DIR = os.environ.get("PANO_GRAPH_DIR", "")
+ARRAYS = ("id_blob", "id_offsets", "lat", "lng", "original_lat", "original_lng",
+          "expanded", "indptr", "indices", "headings")
+
+
+class PanoGraph:
+    """Read-only pano link graph in CSR layout.
+
+    Nodes that were only seen as link targets have no position (NaN) and
+    are not expanded, so their own links are unknown.
+    """
+
+    def __init__(self, arrays):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.id_offsets) - 1
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    def pano_id(self, node):
+        """Returns the pano ID string for a node number."""
+        return bytes(self.id_blob[self.id_offsets[node]:self.id_offsets[node + 1]]).decode()
+
+    def node(self, pano_id):
+        """Returns the node number for a pano ID, or None if it is not in the graph."""
+        key = pano_id.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.id_blob[self.id_offsets[mid]:self.id_offsets[mid + 1]]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.pano_id(lo) == pano_id:
+            return lo
+        return None
+
+    def neighbours(self, node):
+        """Returns (node numbers, headings) arrays for a node's links."""
+        start, end = self.indptr[node], self.indptr[node + 1]
+        return self.indices[start:end], self.headings[start:end]
+
+    def links(self, pano_id):
+        """Returns [(linked pano ID, heading), ...], or None if the pano's links are unknown."""
+        node = self.node(pano_id)
+        if node is None or not self.expanded[node]:
+            return None
+        nodes, headings = self.neighbours(node)
+        return [(self.pano_id(int(n)), float(h)) for n, h in zip(nodes, headings)]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), np.asarray(getattr(self, name)))
+
+
+def load(path, mmap=True):
+    """Opens a graph saved with PanoGraph.save, memory-mapped by default."""
+    mode = "r" if mmap else None
+    return PanoGraph({name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mode)
+                      for name in ARRAYS})
+
+
+def from_metadata(records):
+    """Builds a graph from Tile API metadata responses.
+
+    Args:
+        records: An iterable of metadata dicts, each with panoId, lat, lng and
+          links (as returned by the metadata endpoint).
+    """
+    nodes = {}
+    for data in records:
+        if "panoId" not in data or "lat" not in data:
+            continue
+        links = [(link["panoId"], link.get("heading", 0.0))
+                 for link in data.get("links") or [] if link.get("panoId")]
+        nodes[data["panoId"]] = (data["lat"], data["lng"],
+                                 data.get("originalLat"), data.get("originalLng"), links)
+    return from_nodes(nodes)
+
+
+def from_nodes(nodes):
+    """Builds a graph from {pano_id: (lat, lng, original_lat, original_lng, [(link_id, heading), ...])}."""
+    pano_ids = set(nodes)
+    for _, _, _, _, links in nodes.values():
+        pano_ids.update(link_id for link_id, _ in links)
+    pano_ids = sorted(pano_ids, key=str.encode)
+    numbers = {pano_id: i for i, pano_id in enumerate(pano_ids)}
+
+    encoded = [pano_id.encode() for pano_id in pano_ids]
+    id_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=id_offsets[1:])
+    id_blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    count = len(pano_ids)
+    lat = np.full(count, np.nan)
+    lng = np.full(count, np.nan)
+    original_lat = np.full(count, np.nan)
+    original_lng = np.full(count, np.nan)
+    expanded = np.zeros(count, dtype=bool)
+    degree = np.zeros(count, dtype=np.int64)
+    for pano_id, (node_lat, node_lng, node_original_lat, node_original_lng, links) in nodes.items():
+        i = numbers[pano_id]
+        lat[i], lng[i] = node_lat, node_lng
+        if node_original_lat is not None and node_original_lng is not None:
+            original_lat[i], original_lng[i] = node_original_lat, node_original_lng
+        expanded[i] = True
+        degree[i] = len(links)
+
+    indptr = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(degree, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    headings = np.empty(indptr[-1], dtype=np.float64)
+    for pano_id, (_, _, _, _, links) in nodes.items():
+        start = indptr[numbers[pano_id]]
+        for offset, (link_id, heading) in enumerate(links):
+            indices[start + offset] = numbers[link_id]
+            headings[start + offset] = heading
+
+    return PanoGraph({
+        "id_blob": id_blob, "id_offsets": id_offsets,
+        "lat": lat, "lng": lng, "original_lat": original_lat, "original_lng": original_lng,
+        "expanded": expanded, "indptr": indptr, "indices": indices, "headings": headings,
+    })
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_graph():
+    """Returns the graph set with use_graph or in PANO_GRAPH_DIR, or None if there is none."""
+    global _default
+    with _default_lock:
+        if _default is None and GRAPH_DIR and os.path.exists(os.path.join(GRAPH_DIR, "indptr.npy")):
+            _default = load(GRAPH_DIR)
+    return _default
+
+
+def use_graph(graph):
+    """Replaces the process-wide graph; None falls back to PANO_GRAPH_DIR."""
+    global _default
+    with _default_lock:
+        _default = graph
+
+
+def get_links(pano_id):
+    """Returns [(linked pano ID, heading), ...] from the graph, or None if the graph can't answer."""
+    graph = default_graph()
+    return graph.links(pano_id) if graph else None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python panograph.py <panocache.sqlite> <output_dir>")
+        sys.exit(1)
+    cache = panocache.PanoCache(sys.argv[1], ttl=0)
+    graph = from_metadata(dict(data, panoId=pano_id) for pano_id, data in cache.items(panocache.METADATA))
+    graph.save(sys.argv[2])
+    print(f"Wrote {len(graph)} panos and {graph.edge_count} links to {sys.argv[2]}")
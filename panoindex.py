@@ -0,0 +1,255 @@
+import math
+import os
+import sqlite3
+import sys
+import threading
+import numpy as np
+import geodesy
+import httpclient
+import metrics
+import panocache
+
+# Local index of panoIds answers, used to answer panoIds queries without a
+# network call when every point in them has been asked before. The panoIds
+# API returns panos that link crawls never reach (other captures,
+# photospheres), so the only trustworthy source is the API itself: each
+# answer is recorded per (point, radius), from real panoIds responses, and a
+# query is answered offline only if every one of its points has an answer for
+# the same radius that the API has given CONFIRMATIONS times in a row. Unlike panocache, which keys whole requests,
+# this reuses answers across differently batched requests.
+#
+# Every VERIFY_EVERY-th offline answer is sent to the API anyway and
+# compared; points whose answer changed are replaced and counted in
+# irt_panoindex_checks_total. The index also keeps pano positions for
+# nearest-pano queries, which fakeapi uses to synthesize answers.
+#
+# The index is opt-in: set PANO_INDEX_FILE to enable it.
+INDEX_FILE = os.environ.get("PANO_INDEX_FILE", "")
+GRID_SIZE = 0.0005  # Degrees per grid cell, roughly 50 meters
+CONFIRMATIONS = 2  # Identical API answers needed before a point is answered offline
+VERIFY_EVERY = 20  # One in this many offline answers is checked against the API
+
+
+def point_key(location):
+    return "%s%.7f:%.7f" % (httpclient.api_scope(), location["lat"], location["lng"])
+
+
+def grid_cell(lat, lng):
+    return (math.floor(lat / GRID_SIZE), math.floor(lng / GRID_SIZE))
+
+
+def cell_reach(lat, radius):
+    """Returns how many cells either side of a point a radius can reach."""
+    cell_meters = GRID_SIZE * geodesy.METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.1)
+    return max(1, math.ceil(radius / cell_meters))
+
+
+class PanoIndex:
+    """SQLite-backed index of recorded panoIds answers and pano positions.
+
+    Use ":memory:" as the path for a throwaway index. Safe to share between
+    threads; each process opens its own connection.
+    """
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS panos ("
+                " pano_id TEXT PRIMARY KEY,"
+                " lat REAL NOT NULL,"
+                " lng REAL NOT NULL,"
+                " cell_row INTEGER NOT NULL,"
+                " cell_col INTEGER NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS panos_cell ON panos (cell_row, cell_col)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " radius REAL NOT NULL,"
+                " point TEXT NOT NULL,"
+                " pano_id TEXT NOT NULL,"
+                " confirmations INTEGER NOT NULL,"
+                " PRIMARY KEY (radius, point))"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def add_panos(self, panos):
+        """Adds (pano_id, lat, lng) tuples to the position index."""
+        rows = [(pano_id, lat, lng) + grid_cell(lat, lng) for pano_id, lat, lng in panos]
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO panos (pano_id, lat, lng, cell_row, cell_col) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+
+    def record(self, locations, radius, pano_ids):
+        """Records a panoIds API response, point by point.
+
+        Args:
+            locations: The requested locations, dictionaries with 'lat' and 'lng' keys.
+            radius: The search radius in meters.
+            pano_ids: The API's answer, one pano ID ('' for none) per location.
+
+        Returns:
+            How many points already had a different recorded answer.
+        """
+        radius = float(radius)
+        rows = []
+        changed = 0
+        with self._lock:
+            conn = self._connection()
+            for loc, pano_id in zip(locations, pano_ids):
+                point = point_key(loc)
+                previous = conn.execute(
+                    "SELECT pano_id, confirmations FROM answers WHERE radius = ? AND point = ?", (radius, point),
+                ).fetchone()
+                if previous is None:
+                    confirmations = 1
+                elif previous[0] == pano_id:
+                    confirmations = previous[1] + 1
+                else:
+                    changed += 1
+                    confirmations = 1
+                rows.append((radius, point, pano_id, confirmations))
+            conn.executemany(
+                "INSERT OR REPLACE INTO answers (radius, point, pano_id, confirmations) VALUES (?, ?, ?, ?)", rows,
+            )
+            conn.commit()
+        return changed
+
+    def nearest(self, lat, lng, radius):
+        """Returns the indexed pano closest to the point within radius meters, or ''."""
+        row, col = grid_cell(lat, lng)
+        reach = cell_reach(lat, radius)
+        with self._lock:
+            candidates = self._connection().execute(
+                "SELECT pano_id, lat, lng FROM panos"
+                " WHERE cell_row BETWEEN ? AND ? AND cell_col BETWEEN ? AND ?",
+                (row - reach, row + reach, col - reach, col + reach),
+            ).fetchall()
+        if not candidates:
+            return ""
+        pano_ids, lats, lngs = zip(*candidates)
+        distances = geodesy.haversine_distance(lat, lng, np.array(lats), np.array(lngs))
+        best = int(np.argmin(distances))
+        return pano_ids[best] if distances[best] <= radius else ""
+
+    def lookup(self, locations, radius):
+        """Answers a panoIds query from recorded answers.
+
+        Args:
+            locations: A list of dictionaries with 'lat' and 'lng' keys.
+            radius: The search radius in meters.
+
+        Returns:
+            A list of pano IDs ('' where there is none), in the same shape as
+            the panoIds API response, or None if any location has no
+            confirmed answer for this radius.
+        """
+        answers = []
+        with self._lock:
+            conn = self._connection()
+            for loc in locations:
+                row = conn.execute(
+                    "SELECT pano_id FROM answers WHERE radius = ? AND point = ? AND confirmations >= ?",
+                    (float(radius), point_key(loc), CONFIRMATIONS),
+                ).fetchone()
+                if row is None:
+                    return None
+                answers.append(row[0])
+        return answers
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_index():
+    """Returns the process-wide index, or None if PANO_INDEX_FILE is empty."""
+    global _default
+    if not INDEX_FILE:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = PanoIndex()
+    return _default
+
+
+def use_index(index):
+    """Replaces the process-wide index, e.g. with a scratch one for a benchmark."""
+    global _default
+    with _default_lock:
+        _default = index
+
+
+_offline_answers = 0
+
+
+def lookup(locations, radius):
+    """Answers a panoIds query offline, or returns None if the API is needed.
+
+    Every VERIFY_EVERY-th answer the index could give is withheld, so the
+    caller asks the API and record() checks the recorded answer against it.
+    """
+    global _offline_answers
+    index = default_index()
+    if index is None:
+        return None
+    answers = index.lookup(locations, radius)
+    if answers is None:
+        metrics.cache_lookups.inc(kind="panoindex", result="miss")
+        return None
+    with _default_lock:
+        _offline_answers += 1
+        verify = _offline_answers % VERIFY_EVERY == 0
+    if verify:
+        metrics.cache_lookups.inc(kind="panoindex", result="verify")
+        return None
+    metrics.cache_lookups.inc(kind="panoindex", result="hit")
+    return answers
+
+
+def record(locations, radius, pano_ids):
+    """Records a panoIds API response, logging points whose recorded answer was wrong."""
+    index = default_index()
+    if index is None or pano_ids is None:
+        return
+    changed = index.record(locations, radius, pano_ids)
+    metrics.panoindex_checks.inc(len(pano_ids) - changed, result="match")
+    if changed:
+        metrics.panoindex_checks.inc(changed, result="mismatch")
+        print(f"panoindex: {changed} of {len(pano_ids)} recorded answers changed at radius {radius}")
+
+
+def harvest_cache(index, path):
+    """Records every panoIds response in a panocache database in the index."""
+    cache = panocache.PanoCache(path, ttl=0)
+    count = 0
+    for key, pano_ids in cache.items(panocache.PANO_IDS):
+        radius, points = key.split("|", 1)
+        locations = [{"lat": float(lat), "lng": float(lng)}
+                     for lat, lng in (point.split(":") for point in points.split(","))]
+        index.record(locations, float(radius), pano_ids)
+        count += len(locations)
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: PANO_INDEX_FILE=panoindex.sqlite python panoindex.py <panocache.sqlite> ...")
+        sys.exit(1)
+    index = PanoIndex(INDEX_FILE or "panoindex.sqlite")
+    for path in sys.argv[1:]:
+        print(f"Recorded {harvest_cache(index, path)} panoIds answers from {path}")
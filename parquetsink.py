@@ -0,0 +1,132 @@
+import datetime
+import json
+import logging
+import os
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+import bqwriter
+
+# Local columnar sink for the stop stream, an alternative to BigQuery. Stops
+# are written to Parquet files partitioned by UTC day, under
+# <dir>/day=YYYY-MM-DD/, with the table's schema from bq.schema minus the
+# raw_json column.
+#
+# Rows go through the same durable spool as the BigQuery writer (kept in the
+# output directory as .spool.jsonl) and are only acknowledged once the file
+# holding them is closed. Each delivery writes one complete file per day,
+# named after the spool offset of its first row, under a hidden name that is
+# renamed into place once written. A delivery replayed after a crash starts
+# at the same offset, so it replaces its earlier file rather than
+# duplicating it. FLUSH_INTERVAL sets how much each file holds: about an hour
+# of stops, a few hundred rows, in one row group.
+#
+# Read a range of days with, for example:
+#     pyarrow.dataset.dataset("stops.parquet", partitioning="hive").to_table()
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bq.schema")
+OUTPUT_DIR = os.environ.get("STOP_PARQUET_DIR", "stops.parquet")
+EXCLUDE = ("raw_json",)  # Columns left out of the local files
+MAX_ROWS = 100000  # Rows per file at most
+FLUSH_INTERVAL = 3600.0  # Seconds spooled rows may wait before being written out as files
+COMPRESSION = "zstd"
+
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INTEGER": pa.int64(),
+    "FLOAT": pa.float64(),
+    "BOOLEAN": pa.bool_(),
+}
+
+
+def arrow_field(field):
+    """Converts a BigQuery schema field, as in bq.schema, to an Arrow field."""
+    if field["type"] == "RECORD":
+        type = pa.struct([arrow_field(child) for child in field["fields"]])
+    else:
+        type = ARROW_TYPES[field["type"]]
+    if field.get("mode") == "REPEATED":
+        return pa.field(field["name"], pa.list_(type), nullable=False)
+    return pa.field(field["name"], type, nullable=field.get("mode") != "REQUIRED")
+
+
+def load_schema(path=SCHEMA_FILE, exclude=EXCLUDE):
+    """Returns the Arrow schema for the stops table described by a BigQuery schema file."""
+    with open(path) as f:
+        fields = json.load(f)
+    return pa.schema([arrow_field(field) for field in fields if field["name"] not in exclude])
+
+
+def coerce(value, type):
+    """Converts a JSON value to fit an Arrow type, e.g. numeric totalUsers to a string.
+
+    Keys missing from the type are dropped, and values that can't be
+    converted become None.
+    """
+    if value is None:
+        return None
+    try:
+        if pa.types.is_struct(type):
+            return {child.name: coerce(value.get(child.name), child.type) for child in type}
+        if pa.types.is_list(type):
+            return [coerce(item, type.value_type) for item in value]
+        if pa.types.is_string(type):
+            return value if isinstance(value, str) else json.dumps(value)
+        if pa.types.is_integer(type):
+            return int(value)
+        if pa.types.is_floating(type):
+            return float(value)
+        if pa.types.is_boolean(type):
+            return bool(value)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return value
+
+
+def stop_day(row):
+    """Returns the UTC day of a stop, from its endTime (milliseconds) if it has one."""
+    timestamp = coerce(row.get("endTime"), pa.int64())
+    if timestamp is None:
+        timestamp = time.time() * 1000
+    return datetime.datetime.fromtimestamp(timestamp / 1000, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+
+class ParquetSink(bqwriter.SpoolWriter):
+    """Writes stop rows to day-partitioned Parquet files through a durable spool.
+
+    Has the same add(row) and close() methods as bqwriter.BatchWriter, so
+    either can back longws.
+    """
+
+    sink = "parquet"
+
+    def __init__(self, output_dir=OUTPUT_DIR, schema=None, max_rows=MAX_ROWS, flush_interval=FLUSH_INTERVAL):
+        self.output_dir = output_dir
+        self.schema = schema if schema is not None else load_schema()
+        os.makedirs(output_dir, exist_ok=True)
+        super().__init__(os.path.join(output_dir, ".spool.jsonl"), max_rows, flush_interval)
+
+    def shape(self, row):
+        """Coerces a stop row to the schema."""
+        shaped = {field.name: coerce(row.get(field.name), field.type) for field in self.schema}
+        for field in self.schema:
+            if pa.types.is_list(field.type) and shaped[field.name] is None:
+                shaped[field.name] = []
+        return shaped
+
+    def deliver(self, batch):
+        """Writes the batch as one closed file per day; any failure retries the whole batch."""
+        days = {}
+        for entry in batch:
+            days.setdefault(stop_day(entry[1]), []).append(entry)
+        for day, entries in days.items():
+            directory = os.path.join(self.output_dir, f"day={day}")
+            os.makedirs(directory, exist_ok=True)
+            name = "part-%020d.parquet" % entries[0][3]
+            hidden_path = os.path.join(directory, "." + name)
+            table = pa.Table.from_pylist([self.shape(entry[1]) for entry in entries], schema=self.schema)
+            pq.write_table(table, hidden_path, row_group_size=len(entries), compression=COMPRESSION)
+            with open(hidden_path, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(hidden_path, os.path.join(directory, name))
+            logging.info(f"Wrote {len(entries)} stops to {os.path.join(directory, name)}")
+        return []
@@ -0,0 +1,82 @@
+import logging
+import queue
+import threading
+import time
+import metrics
+
+# Stages connected by bounded queues, for ingest loops that must not block
+# their source. Each stage runs its handler on its own worker threads and
+# hands whatever the handler returns to the next stage. A full downstream
+# queue blocks the upstream workers, so a slow sink backs up through the
+# pipeline instead of piling up in memory; only the source end, offer(),
+# never blocks, and sheds its oldest item instead once its queue is full.
+QUEUE_SIZE = 1000  # Items a stage's queue holds before backpressure applies
+
+
+class Stage:
+    """A bounded queue drained by worker threads running handler(item).
+
+    Args:
+        name: Label for the stage's queue depth and lag metrics.
+        handler: Called with each item; a non-None return value is put on the
+            next stage, waiting while that stage's queue is full.
+        maxsize: Queue bound.
+        workers: Threads running the handler. Use 1 where items must be
+            handled in order.
+        next: The stage results are passed to, or None.
+    """
+
+    def __init__(self, name, handler, maxsize=QUEUE_SIZE, workers=1, next=None):
+        self.name = name
+        self.handler = handler
+        self.next = next
+        self.queue = queue.Queue(maxsize)
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        """Queues an item, waiting while the queue is full."""
+        self.queue.put((time.monotonic(), item))
+        metrics.pipeline_queue_depth.set(self.queue.qsize(), stage=self.name)
+
+    def offer(self, item):
+        """Queues an item without waiting, dropping the oldest queued item if full.
+
+        Returns:
+            False if an item was dropped to make room.
+        """
+        dropped = False
+        while True:
+            try:
+                self.queue.put_nowait((time.monotonic(), item))
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    dropped = True
+                    metrics.pipeline_dropped.inc(stage=self.name)
+                except queue.Empty:
+                    pass
+        metrics.pipeline_queue_depth.set(self.queue.qsize(), stage=self.name)
+        return not dropped
+
+    def _run(self):
+        while True:
+            queued_at, item = self.queue.get()
+            metrics.pipeline_queue_depth.set(self.queue.qsize(), stage=self.name)
+            metrics.pipeline_lag_seconds.observe(time.monotonic() - queued_at, stage=self.name)
+            try:
+                result = self.handler(item)
+                if result is not None and self.next is not None:
+                    self.next.put(result)
+            except Exception as e:
+                logging.error(f"Stage {self.name} failed on an item: {e}")
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """Waits until every item queued so far has been handled."""
+        self.queue.join()
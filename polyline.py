@@ -0,0 +1,150 @@
+import argparse
+import json
+import numpy as np
+import geodesy
+
+# Compact output for crawl results. Crawled LineStrings have a vertex for every
+# pano, most of them on straight stretches of road, plus the full panoIds list
+# in every feature. compact() simplifies each line with Douglas-Peucker,
+# stores its geometry as an encoded polyline (the Google polyline format, with
+# decoders for most map libraries), and moves the pano IDs out to a side
+# table that only needs loading when a pano is looked up.
+TOLERANCE = 2.0  # Meters a simplified line may stray from the panos it passes
+PRECISION = 5  # Decimal places kept by the polyline encoding, about 1 meter
+
+
+def simplify(coords, tolerance=TOLERANCE):
+    """Douglas-Peucker simplification of [[lng, lat], ...] coordinates.
+
+    Returns:
+        The indices of the vertices kept, always including the first and last.
+    """
+    points = np.asarray(coords, dtype=float)
+    if len(points) < 3:
+        return list(range(len(points)))
+    # Project onto a local plane in meters, good enough at street scale.
+    lat0 = np.radians(points[:, 1].mean())
+    x = np.radians(points[:, 0]) * np.cos(lat0) * geodesy.EARTH_RADIUS
+    y = np.radians(points[:, 1]) * geodesy.EARTH_RADIUS
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(dx * py - dy * px) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return [int(i) for i in np.flatnonzero(keep)]
+
+
+def encode(coords, precision=PRECISION):
+    """Encodes [[lng, lat], ...] coordinates as a polyline string (lat, lng order)."""
+    factor = 10 ** precision
+    chunks = []
+    previous = (0, 0)
+    for lng, lat in coords:
+        current = (int(round(lat * factor)), int(round(lng * factor)))
+        for value, last in zip(current, previous):
+            delta = value - last
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                chunks.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            chunks.append(chr(delta + 63))
+        previous = current
+    return "".join(chunks)
+
+
+def decode(encoded, precision=PRECISION):
+    """Decodes a polyline string back to [[lng, lat], ...] coordinates."""
+    factor = 10 ** precision
+    coords = []
+    values = [0, 0]
+    index = 0
+    while index < len(encoded):
+        for i in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            values[i] += ~(result >> 1) if result & 1 else result >> 1
+        coords.append([values[1] / factor, values[0] / factor])
+    return coords
+
+
+def read_features(path):
+    """Yields the features of a GeoJSON FeatureCollection or newline-delimited GeoJSON file."""
+    with open(path) as f:
+        try:
+            first = json.loads(f.readline())
+        except ValueError:
+            first = None
+        f.seek(0)
+        if isinstance(first, dict) and first.get("type") == "Feature":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)["features"]
+
+
+def compact(input_path, output_prefix, tolerance=TOLERANCE, precision=PRECISION):
+    """Writes a crawl's LineStrings out in the compact format.
+
+    Writes output_prefix + ".lines.json", the map data:
+        {"precision": 5, "tolerance": 2.0, "strokes": ["#e6194B", ...],
+         "lines": [[encoded polyline, stroke index or -1], ...]}
+    and output_prefix + ".panos.json", the side table:
+        {"lines": [[pano_id, ...], ...]}
+    with the full, unsimplified pano IDs of each line, in the same order.
+
+    Returns:
+        (lines, vertices before, vertices after).
+    """
+    lines, pano_lines, strokes = [], [], {}
+    before = after = 0
+    for feature in read_features(input_path):
+        if feature["geometry"]["type"] != "LineString":
+            continue
+        coords = feature["geometry"]["coordinates"]
+        kept = simplify(coords, tolerance)
+        before += len(coords)
+        after += len(kept)
+        stroke = feature["properties"].get("stroke")
+        stroke_index = strokes.setdefault(stroke, len(strokes)) if stroke else -1
+        lines.append([encode([coords[i] for i in kept], precision), stroke_index])
+        pano_lines.append(feature["properties"].get("panoIds", []))
+    with open(output_prefix + ".lines.json", "w") as f:
+        json.dump({"precision": precision, "tolerance": tolerance, "strokes": list(strokes),
+                   "lines": lines}, f, separators=(",", ":"))
+    with open(output_prefix + ".panos.json", "w") as f:
+        json.dump({"lines": pano_lines}, f, separators=(",", ":"))
+    return len(lines), before, after
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simplify and encode crawled LineStrings compactly.")
+    parser.add_argument("input", help="GeoJSON or .ndjson output from sv.py or crawlcoord.py.")
+    parser.add_argument("output_prefix", help="Writes <prefix>.lines.json and <prefix>.panos.json.")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Simplification tolerance in meters.")
+    parser.add_argument("--precision", type=int, default=PRECISION, help="Decimal places to encode.")
+    args = parser.parse_args()
+    count, before, after = compact(args.input, args.output_prefix, args.tolerance, args.precision)
+    print(f"Wrote {count} lines, {after} of {before} vertices kept, to {args.output_prefix}.lines.json"
+          f" and {args.output_prefix}.panos.json")
@@ -1,5 +1,6 @@
 import json
 import requests
+import httpclient
 
 def extract_ids_within_bounds(json_data_string, min_lat, min_lng, max_lat, max_lng):
     """
@@ -52,7 +53,7 @@ def fetch_and_extract_items(id_dicts):
       lng = id_dict['lng']
       url = f"https://radio.garden/api/ara/content/secure/page/{id}/channels"
       try:
-          response = requests.get(url, headers={'User-Agent': user_agent})
+          response = httpclient.get(url, headers={'User-Agent': user_agent})
           response.raise_for_status()  # Raise an exception for bad status codes
           data = response.json()
           if 'data' in data and 'content' in data['data'] and data['data']['content'] and 'items' in data['data']['content'][0]:
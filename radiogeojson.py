@@ -1,6 +1,6 @@
 import csv
-import json
-import math
+import geodesy
+import geojsonstream
 
 def read_csv_data(file_path):
     """Reads data from a CSV file and returns a list of dictionaries."""
@@ -30,26 +30,11 @@ def create_geojson_feature(row):
     # Radius of the circle in kilometers
     radius_km = 100
     
-    # Approximate conversion of km to degrees (simplified)
-    radius_lat_deg = radius_km / 111.0  # 1 degree of latitude is approx 111 km
-    radius_lng_deg = radius_km / (111.0 * math.cos(math.radians(lat))) # adjust for latitude
-
     # Number of vertices for the polygon
     num_vertices = 36
-    
-    # Generate vertices
-    vertices = []
-    for i in range(num_vertices):
-        angle_rad = 2 * math.pi * i / num_vertices
-        
-        # Calculate vertex coordinates
-        vertex_lat = lat + radius_lat_deg * math.sin(angle_rad)
-        vertex_lng = lng + radius_lng_deg * math.cos(angle_rad)
-        
-        vertices.append([vertex_lng, vertex_lat])
-    
-    # Close the polygon by adding the first vertex again
-    vertices.append(vertices[0])
+
+    # Generate vertices, closing the polygon with the first vertex again
+    vertices = geodesy.degree_circle(lat, lng, radius_km, num_vertices).tolist()
 
     feature = {
         "type": "Feature",
@@ -83,30 +68,20 @@ if __name__ == "__main__":
     # Read the CSV data
     data = read_csv_data(csv_file_path)
 
-    # Create GeoJSON features
-    geojson_features = []
-    for row in data:
-        try:
-          lng = float(row['geolong'])
-          lat = float(row['geolat'])
-        except ValueError:
-          print(f"Warning: invalid geolat/geolong values for row: {row}. Skipping")
-          continue
-        if is_within_bounding_box(lat, lng):
-          feature = create_geojson_feature(row)
-          if feature:
-            geojson_features.append(feature)
-        else:
-          print(f"Warning: Skipping station {row['name']} because it is outside the bounding box.")
-
-    # Create the GeoJSON FeatureCollection
-    geojson_output = {
-        "type": "FeatureCollection",
-        "features": geojson_features
-    }
-
-    # Write the GeoJSON data to a file
-    with open(geojson_output_file, "w", encoding='utf-8') as f:
-        json.dump(geojson_output, f, indent=2)
+    # Stream GeoJSON features to the output file as they are created
+    with geojsonstream.FeatureWriter(geojson_output_file) as writer:
+        for row in data:
+            try:
+              lng = float(row['geolong'])
+              lat = float(row['geolat'])
+            except ValueError:
+              print(f"Warning: invalid geolat/geolong values for row: {row}. Skipping")
+              continue
+            if is_within_bounding_box(lat, lng):
+              feature = create_geojson_feature(row)
+              if feature:
+                writer.write(feature)
+            else:
+              print(f"Warning: Skipping station {row['name']} because it is outside the bounding box.")
 
     print(f"GeoJSON data written to {geojson_output_file}")
\ No newline at end of file
@@ -0,0 +1,186 @@
+import contextlib
+import threading
+import time
+import urllib.parse
+
+# Process-wide request pacing. Every call made through httpclient waits for a
+# token from its endpoint's bucket (fixed QPS) and a slot from its adaptive
+# concurrency limit, which grows while responses are fast and successful and
+# halves on 429s or slow responses.
+ENDPOINT_LIMITS = {
+    # Tile API quotas are per method, so metadata and panoIds are paced apart.
+    "metadata": {"qps": 100, "burst": 20, "initial_concurrency": 8, "max_concurrency": 64},
+    "panoIds": {"qps": 20, "burst": 5, "initial_concurrency": 4, "max_concurrency": 16},
+    "roadtrip.pikarocks.dev": {"qps": 10, "burst": 1, "initial_concurrency": 1, "max_concurrency": 2},
+    "radio.garden": {"qps": 10, "burst": 5, "initial_concurrency": 4, "max_concurrency": 8},
+}
+DEFAULT_LIMITS = {"qps": 20, "burst": 5, "initial_concurrency": 4, "max_concurrency": 16}
+THROTTLE_STATUSES = (429, 503)  # Responses that mean the server wants us to slow down
+TARGET_LATENCY = 2.0  # Seconds; slower responses shrink the concurrency limit
+BACKOFF_RATIO = 0.5  # Multiplier applied to the concurrency limit on a throttle
+DECREASE_COOLDOWN = 1.0  # Seconds between successive decreases
+
+
+def endpoint_for(url):
+    """Returns the ENDPOINT_LIMITS name for a request URL.
+
+    Street View Tile API calls, on the real API or a local stand-in, are keyed
+    by method ('metadata' or 'panoIds'); anything else is keyed by host name.
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.path.startswith("/v1/streetview/"):
+        return parsed.path.rstrip("/").rsplit("/", 1)[-1]
+    return parsed.hostname
+
+
+class TokenBucket:
+    """Allows qps calls per second on average, with bursts of up to burst calls."""
+
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.qps)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.qps
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """Concurrency limit adjusted by additive increase, multiplicative decrease.
+
+    Each fast, successful response raises the limit by 1/limit, so it grows by
+    about one per round of requests. A throttle status or a response slower than
+    target_latency multiplies it by BACKOFF_RATIO, at most once per
+    DECREASE_COOLDOWN so one burst of throttles doesn't collapse it.
+    """
+
+    def __init__(self, initial_concurrency, max_concurrency, min_concurrency=1,
+                 target_latency=TARGET_LATENCY):
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def record(self, status, latency):
+        """Adjusts the limit from one response's status code and latency in seconds."""
+        with self._cond:
+            if status in THROTTLE_STATUSES or latency > self.target_latency:
+                self.throttle()
+            elif status is not None and status < 500:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def throttle(self):
+        """Shrinks the limit after a throttling signal."""
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease >= DECREASE_COOLDOWN:
+                self.limit = max(self.min_concurrency, self.limit * BACKOFF_RATIO)
+                self._last_decrease = now
+
+
+class EndpointLimiter:
+    """Token bucket plus adaptive concurrency limit for one endpoint."""
+
+    def __init__(self, qps, burst, initial_concurrency, max_concurrency):
+        self.bucket = TokenBucket(qps, burst)
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, max_concurrency)
+
+    @contextlib.contextmanager
+    def request(self):
+        """Waits for a token and a concurrency slot for the duration of a call.
+
+        Yields a function to call with the response status code (or None on a
+        connection error) so the concurrency limit can adapt.
+        """
+        if not _enabled:
+            yield lambda status: None
+            return
+        self.bucket.acquire()
+        self.concurrency.acquire()
+        start = time.monotonic()
+        statuses = []
+        try:
+            yield statuses.append
+        finally:
+            self.concurrency.release()
+            status = statuses[-1] if statuses else None
+            self.concurrency.record(status, time.monotonic() - start)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_enabled = True
+
+
+def limiter(endpoint):
+    """Returns the shared EndpointLimiter for an endpoint name."""
+    with _limiters_lock:
+        if endpoint not in _limiters:
+            _limiters[endpoint] = EndpointLimiter(**ENDPOINT_LIMITS.get(endpoint, DEFAULT_LIMITS))
+        return _limiters[endpoint]
+
+
+def limiter_for(url):
+    """Returns the shared EndpointLimiter for a request URL."""
+    return limiter(endpoint_for(url))
+
+
+def configure(endpoint, **limits):
+    """Overrides the limits for an endpoint, e.g. configure("metadata", qps=50).
+
+    Takes the same keys as ENDPOINT_LIMITS entries and replaces any limiter
+    already created for the endpoint.
+    """
+    with _limiters_lock:
+        ENDPOINT_LIMITS[endpoint] = dict(ENDPOINT_LIMITS.get(endpoint, DEFAULT_LIMITS), **limits)
+        _limiters.pop(endpoint, None)
+
+
+def share(parts):
+    """Scales every endpoint's limits down to 1/parts of their value.
+
+    For when several processes split one quota between them, e.g. the shards
+    of a validation run. Call it in each process before making requests.
+    """
+    def scaled(limits):
+        return {"qps": limits["qps"] / parts,
+                "burst": max(1, limits["burst"] // parts),
+                "initial_concurrency": max(1, limits["initial_concurrency"] // parts),
+                "max_concurrency": max(1, limits["max_concurrency"] // parts)}
+
+    DEFAULT_LIMITS.update(scaled(DEFAULT_LIMITS))
+    for endpoint, limits in list(ENDPOINT_LIMITS.items()):
+        configure(endpoint, **scaled(limits))
+
+
+def disable():
+    """Stops pacing requests in this process, e.g. against a local fakeapi server."""
+    global _enabled
+    _enabled = False
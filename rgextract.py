@@ -2,6 +2,7 @@ import json
 import csv
 import os
 import requests
+import httpclient
 
 def extract_and_write_csv(input_file, output_file):
     """
@@ -47,7 +48,7 @@ def extract_and_write_csv(input_file, output_file):
                 stream_url = f"/api/ara/content/listen/{item_id}/channel.mp3?1748180090815"
                 base_url = "https://radio.garden"
                 try:
-                  response = requests.get(base_url + stream_url, allow_redirects=False, timeout=3)
+                  response = httpclient.get(base_url + stream_url, allow_redirects=False, timeout=3)
                   response.raise_for_status()
                   streaming_url = response.headers.get('Location')
                 except requests.exceptions.RequestException as e:
@@ -0,0 +1,39 @@
+import concurrent.futures
+import threading
+
+
+class Group:
+    """Coalesces concurrent calls that share a key into one in-flight call.
+
+    The first caller for a key runs the function; callers that arrive with the
+    same key while it is still running wait for it and get the same result
+    (or exception) instead of issuing a duplicate request. Once the call
+    finishes the key is forgotten, so later calls run again as normal.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs), or waits on an identical call already running."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._calls[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
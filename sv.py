@@ -1,10 +1,20 @@
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
 import json
+import os
 import random
 import sys
+import threading
+import time
 import requests
+import httpclient
+import geojsonstream
 import keys
-
-url = "https://tile.googleapis.com/v1/streetview/metadata"
+import panocache
+import panograph
+import polyline
 
 # Base parameters for the API request, session and key are from your example
 base_params = {
@@ -17,7 +27,14 @@ base_params = {
 # Global set to keep track of panos whose data has been fetched and processed
 # This prevents re-fetching and re-exploring from the same pano multiple times.
 processed_pano_ids = set()
-geojson_features = []  # To store GeoJSON LineString features
+# Where LineString features go as they are found; a geojsonstream.FeatureWriter.
+feature_writer = None
+# Digests of the (panoIds, stroke) of every feature written, so duplicates are
+# found by hashing rather than by keeping every feature around to compare.
+feature_keys = set()
+# Adjacency of every crawled pano, saved as a panograph store after the crawl:
+# {pano_id: (lat, lng, original_lat, original_lng, [(link_id, heading), ...])}
+graph_nodes = {}
 
 # List of distinct RGB colors
 color_palette = [
@@ -46,175 +63,390 @@ color_palette = [
 ]
 color_index = 0
 MAX_DEPTH = 300  # Remains as per your existing code
+FETCH_WORKERS = 16  # Metadata requests in flight at once
+PREFETCH_DEPTH = 4  # Links fetched ahead of the walk, in hops from a visited pano
+MAX_PENDING = 256  # Prefetches queued or in flight before new ones are skipped
+CHECKPOINT_FILE = "output.checkpoint.json.gz"
+CHECKPOINT_INTERVAL = 60  # Seconds between crawl checkpoints
 
 
-def build_lines_recursive(
-    pano_id_to_process, current_depth, accumulated_path_nodes
-):
-  global color_index
+def path_nodes(path):
+  """Returns the ([lng, lat], pano_id) nodes of a path, first to last.
+
+  Paths are chains of (coords, pano_id, parent) tuples ending at the newest
+  node, so every branch of the crawl shares the nodes it has in common with
+  its siblings instead of holding its own copy. None is the empty path.
+  """
+  nodes = []
+  while path is not None:
+    coords, pano_id, path = path
+    nodes.append((coords, pano_id))
+  nodes.reverse()
+  return nodes
+
+
+def feature_key(ids, stroke):
+  return hashlib.blake2b("\n".join(ids + [stroke or ""]).encode(), digest_size=16).digest()
 
-  # accumulated_path_nodes is a list of tuples: [([lng, lat], pano_id), ...]
-
-  # Termination Condition 1: Max depth reached for pano_id_to_process
-  if current_depth > MAX_DEPTH:
-    if len(accumulated_path_nodes) >= 2:
-      coords = [node[0] for node in accumulated_path_nodes]
-      ids = [node[1] for node in accumulated_path_nodes]
-      feature = {
-          "type": "Feature",
-          "geometry": {"type": "LineString", "coordinates": coords},
-          "properties": {
-              "panoIds": ids,
-              "stroke": color_palette[color_index],
-              "stroke-width": 10,
-          },
-      }
-      if feature not in geojson_features:
-        geojson_features.append(feature)
-      color_index = (color_index + 1) % len(color_palette)
-    return
 
-  # Termination Condition 2: pano_id_to_process has already been processed.
-  # The current path leading up to it is a complete line segment.
-  if pano_id_to_process in processed_pano_ids:
-    if len(accumulated_path_nodes) >= 2:
-
-      coords = [node[0] for node in accumulated_path_nodes]
-      ids = [node[1] for node in accumulated_path_nodes]
-      feature = {
-          "type": "Feature",
-          "geometry": {"type": "LineString", "coordinates": coords},
-          "properties": {"panoIds": ids, "stroke-width": 10},
-      }
-      if feature not in geojson_features:
-        geojson_features.append(feature)
+def add_feature(path, colored=True):
+  """Adds a LineString for a finished path.
+
+  Paths cut short (by the depth limit, a failed fetch or a dead end) get the
+  next palette color; paths that ran into an already processed pano don't.
+  """
+  global color_index
+  if path is None or path[2] is None:  # Fewer than two nodes
     return
+  nodes = path_nodes(path)
+  coords = [node[0] for node in nodes]
+  ids = [node[1] for node in nodes]
+  stroke = color_palette[color_index] if colored else None
+  key = feature_key(ids, stroke)
+  if key not in feature_keys:
+    feature_keys.add(key)
+    properties = {"panoIds": ids, "stroke-width": 10}
+    if colored:
+      properties = {"panoIds": ids, "stroke": stroke, "stroke-width": 10}
+    feature_writer.write({
+        "type": "Feature",
+        "geometry": {"type": "LineString", "coordinates": coords},
+        "properties": properties,
+    })
+  if colored:
+    color_index = (color_index + 1) % len(color_palette)
 
-  processed_pano_ids.add(pano_id_to_process)
 
-  current_params = base_params.copy()
-  current_params["panoId"] = pano_id_to_process
-  data = None
-  try:
-    r = requests.get(url, params=current_params)
+def fetch_metadata(pano_id):
+  """Returns metadata for a pano from the cache or the API.
+
+  Returns None when the API says there is no such pano. Quota errors
+  (429), server errors, connection errors and unreadable responses are
+  raised, once httpclient's retries are used up, so the crawl stops and
+  checkpoints with the pano left to retry rather than treating it as a
+  dead end.
+  """
+  data = panocache.get_metadata(pano_id)
+  if data is None:
+    current_params = base_params.copy()
+    current_params["panoId"] = pano_id
+    r = httpclient.get(httpclient.tile_api_url("metadata"), params=current_params)
+    if 400 <= r.status_code < 500 and r.status_code != 429:
+      print(f"No metadata for pano {pano_id}: HTTP {r.status_code} {r.text[:200]}")
+      return None
     r.raise_for_status()
     data = r.json()
-  except requests.exceptions.RequestException as e:
-    print(f"Error fetching data for pano {pano_id_to_process}: {e}", e.response.json())
-  except ValueError as e:  # Includes JSONDecodeError
-    print(f"Error decoding JSON for pano {pano_id_to_process}: {e}")
-  if data is None:  # API call failed or JSON decoding failed
-    if len(accumulated_path_nodes) >= 2:  # Save path so far
-      coords = [node[0] for node in accumulated_path_nodes]
-      ids = [node[1] for node in accumulated_path_nodes]
-      feature = {
-          "type": "Feature",
-          "geometry": {"type": "LineString", "coordinates": coords},
-          "properties": {
-              "panoIds": ids,
-              "stroke": color_palette[color_index],
-              "stroke-width": 10,
-          },
-      }
-      if feature not in geojson_features:
-        geojson_features.append(feature)
-      color_index = (color_index + 1) % len(color_palette)
-      if feature not in geojson_features:
-        geojson_features.append(feature)
-    return
+    panocache.put_metadata(pano_id, data)
+  return data
 
-  lat = data.get("lat")
-  lng = data.get("lng")
-  links_api = data.get("links", [])
-  if lat is None or lng is None:
-    print(f"Warning: No lat/lng for pano {pano_id_to_process}. Data: {data}")
-    if len(accumulated_path_nodes) >= 2:  # Save path so far
-      coords = [node[0] for node in accumulated_path_nodes]
-      ids = [node[1] for node in accumulated_path_nodes]
-      feature = {
-          "type": "Feature",
-          "geometry": {"type": "LineString", "coordinates": coords},
-          "properties": {
-              "panoIds": ids,
-              "stroke": color_palette[color_index],
-              "stroke-width": 10,
-          },
-      }
-      if feature not in geojson_features:
-        geojson_features.append(feature)
-      color_index = (color_index + 1) % len(color_palette)
-      if feature not in geojson_features:
-        geojson_features.append(feature)
-    return
-  print(data['date'])
-  link_ids = [link.get("panoId") for link in links_api]
-  # Current pano is valid, print its info
-  print(f"PanoID: {pano_id_to_process}, Lat: {lat}, Lng: {lng}, \n  Links: {link_ids}")
-
-  # Path extended with the current pano's data
-  current_node_data = ([lng, lat], pano_id_to_process)
-  new_accumulated_path = accumulated_path_nodes + [current_node_data]
-
-  explorable_linked_pano_ids = []
-  if isinstance(links_api, list):
-    for link in links_api:
-      linked_pano_id = link.get("panoId")
-      # Explore link if it has a panoId AND it hasn't been processed globally yet
-      if linked_pano_id and linked_pano_id not in processed_pano_ids:
-        explorable_linked_pano_ids.append(linked_pano_id)
-
-  if not explorable_linked_pano_ids:
-    # This node is a terminal node for new exploration.
-    # The new_accumulated_path (including current node) is a complete line.
-    if len(new_accumulated_path) >= 2:
-      coords = [node[0] for node in new_accumulated_path]
-      ids = [node[1] for node in new_accumulated_path]
-      feature = {
-          "type": "Feature",
-          "geometry": {"type": "LineString", "coordinates": coords},
-          "properties": {
-              "panoIds": ids,
-              "stroke": color_palette[color_index],
-              "stroke-width": 10,
-          },
-      }
-      if feature not in geojson_features:
-        geojson_features.append(feature)
-      color_index = (color_index + 1) % len(color_palette)
-      if feature not in geojson_features:
-        geojson_features.append(feature)
-    return
 
-  # Branch out: for each explorable_linked_pano_id, make a recursive call
-  for next_pano_id in explorable_linked_pano_ids:
-    # Pass a copy of the new_accumulated_path for each new branch
-    build_lines_recursive(
-        next_pano_id, current_depth + 1, list(new_accumulated_path)
-    )
+class Prefetcher:
+  """Fetches metadata on a thread pool ahead of the crawl that needs it.
+
+  Once a pano's metadata arrives, its links are requested too, up to
+  PREFETCH_DEPTH hops out from the panos the crawl has reached, so the
+  pool stays busy while the crawl walks the graph one pano at a time.
+  """
+
+  def __init__(self, workers=FETCH_WORKERS, claim=None, follow=None):
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    self.claim = claim
+    self.follow = follow
+    self.futures = {}
+    self.pending = 0
+    self.closed = False
+    self.lock = threading.Lock()
+
+  def prefetch(self, pano_id, hops=1):
+    with self.lock:
+      if (self.closed or pano_id in self.futures or pano_id in processed_pano_ids
+          or self.pending >= MAX_PENDING):
+        return
+      if self.claim is not None and not self.claim(pano_id):
+        return  # Another crawler has it
+      self.pending += 1
+      future = self.executor.submit(fetch_metadata, pano_id)
+      self.futures[pano_id] = future
+    future.add_done_callback(lambda f: self._done(f, hops))
+
+  def _done(self, future, hops):
+    with self.lock:
+      self.pending -= 1
+    data = None if future.cancelled() or future.exception() else future.result()
+    if data and hops < PREFETCH_DEPTH and isinstance(data.get("links"), list):
+      for link in data["links"]:
+        if link.get("panoId") and (self.follow is None or self.follow(data, link)):
+          self.prefetch(link["panoId"], hops + 1)
+
+  def get(self, pano_id):
+    """Returns the metadata for pano_id, waiting for it if needed."""
+    with self.lock:
+      future = self.futures.pop(pano_id, None)
+    if future is None:
+      return fetch_metadata(pano_id)
+    return future.result()
+
+  def shutdown(self):
+    with self.lock:
+      self.closed = True
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def save_checkpoint(path, initial_pano_id, stack):
+  """Writes everything needed to carry on a crawl to a gzipped JSON file.
+
+  Paths on the stack share their prefixes, so each path node is written
+  once to a table and referred to by index. Features are already in the
+  output file; the checkpoint records how far into it they go.
+  """
+  path_table = []
+  path_index = {}
 
+  def intern(path):
+    # Walks up to the nearest node already in the table, then adds the rest.
+    chain = []
+    while path is not None and id(path) not in path_index:
+      chain.append(path)
+      path = path[2]
+    parent = path_index[id(path)] if path is not None else None
+    for node in reversed(chain):
+      path_table.append([node[0], node[1], parent])
+      parent = path_index[id(node)] = len(path_table) - 1
+    return parent
 
-# Initial panorama ID from your example
-initial_pano_id = sys.argv[1] #(  # Make sure this is the desired start
-#    "KGOB4Z-fiYK1C7OkrQc4yw"
-#)
-geojson_features.clear()  # Ensure lists are empty for a fresh run
-processed_pano_ids.clear()
-color_index = 0  # Reset the color index
+  state = {
+      "initial_pano_id": initial_pano_id,
+      "color_index": color_index,
+      "processed": sorted(processed_pano_ids),
+      "graph_nodes": graph_nodes,
+      "stack": [[pano_id, depth, intern(path)] for pano_id, depth, path in stack],
+      "paths": path_table,
+      "feature_keys": sorted(key.hex() for key in feature_keys),
+      "output": feature_writer.path,
+      "output_offset": feature_writer.tell(),
+      "output_count": feature_writer.count,
+  }
+  tmp_path = path + ".tmp"
+  with gzip.open(tmp_path, "wt") as f:
+    json.dump(state, f, separators=(",", ":"))
+  os.replace(tmp_path, path)
 
-print(
-    f"Starting scrape from PanoID: {initial_pano_id} up to {MAX_DEPTH} levels"
-    " deep to build LineStrings."
-)
-# Initial call to the recursive function. Depth 0, empty path.
-build_lines_recursive(initial_pano_id, 0, [])
 
-# Create the GeoJSON FeatureCollection
-geojson_output = {"type": "FeatureCollection", "features": geojson_features}
+def load_checkpoint(path):
+  """Restores the crawl state saved by save_checkpoint.
+
+  Reopens the output file the checkpoint was writing as feature_writer.
+
+  Returns:
+    The (initial_pano_id, stack) to hand back to crawl.
+  """
+  global color_index, feature_writer
+  with gzip.open(path, "rt") as f:
+    state = json.load(f)
+  color_index = state["color_index"]
+  processed_pano_ids.clear()
+  processed_pano_ids.update(state["processed"])
+  graph_nodes.clear()
+  for pano_id, (lat, lng, original_lat, original_lng, links) in state["graph_nodes"].items():
+    graph_nodes[pano_id] = (lat, lng, original_lat, original_lng, [tuple(link) for link in links])
+  paths = []
+  for coords, pano_id, parent in state["paths"]:
+    paths.append((coords, pano_id, paths[parent] if parent is not None else None))
+  stack = [(pano_id, depth, paths[index] if index is not None else None)
+           for pano_id, depth, index in state["stack"]]
+  feature_keys.clear()
+  feature_keys.update(bytes.fromhex(key) for key in state["feature_keys"])
+  # Drop anything written to the output after the checkpoint, and carry on from there.
+  feature_writer = geojsonstream.FeatureWriter(
+      state["output"], offset=state["output_offset"], count=state["output_count"])
+  return state["initial_pano_id"], stack
+
+
+def reset(writer):
+  """Clears the crawl state and sends features to writer, for a fresh crawl."""
+  global feature_writer, color_index
+  feature_writer = writer
+  feature_keys.clear()
+  processed_pano_ids.clear()
+  graph_nodes.clear()
+  color_index = 0
+
+
+def crawl(initial_pano_id, max_depth=MAX_DEPTH, max_nodes=None, workers=FETCH_WORKERS,
+          checkpoint_file=None, stack=None, accept=None, claim=None, follow=None, hand_off=None):
+  """Crawls the pano graph from initial_pano_id and builds LineString features.
+
+  Walks the graph depth first in the same order, and cuts it into the same
+  lines, as the recursive crawler this replaced, but with an explicit
+  stack and with metadata fetched ahead on a thread pool.
+
+  Args:
+    initial_pano_id: The pano to start from.
+    max_depth: Links followed from the start before a path is cut off.
+    max_nodes: Panos to process before every remaining path is cut off,
+      or None for no limit.
+    workers: Metadata requests in flight at once.
+    checkpoint_file: Where to save the crawl state every CHECKPOINT_INTERVAL
+      seconds and when the crawl fails or is interrupted, or None.
+    stack: The stack from load_checkpoint, to resume a crawl.
+    accept: Optional accept(pano_id, data) called once a pano's metadata is
+      in. If it returns False the pano is not crawled: the path is
+      ended there, including the pano, and its links aren't followed.
+    claim: Optional claim(pano_id) called before a pano is fetched, for
+      the crawl or for prefetching. If it returns False another
+      crawler already has it, which is treated like reaching an already
+      processed pano. It must keep returning True for panos this crawl
+      claimed.
+    follow: Optional follow(data, link) deciding, without fetching it,
+      whether a linked pano is crawled here. Links it rejects are passed to
+      hand_off(pano_id, data, link), if given, and the path ends before them.
+  """
+  prefetcher = Prefetcher(workers, claim, follow)
+  # Each entry is (pano_id, depth, path of the panos before it).
+  if stack is None:
+    stack = [(initial_pano_id, 0, None)]
+  last_checkpoint = time.monotonic()
+  entry = None
+  try:
+    while stack:
+      entry, claimed = None, False
+      if checkpoint_file and time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+        save_checkpoint(checkpoint_file, initial_pano_id, stack)
+        last_checkpoint = time.monotonic()
+      entry = stack.pop()
+      pano_id_to_process, current_depth, accumulated_path_nodes = entry
+
+      # Termination Condition 1: Max depth (or the node budget) reached for pano_id_to_process
+      if current_depth > max_depth or (max_nodes is not None and len(processed_pano_ids) >= max_nodes):
+        add_feature(accumulated_path_nodes)
+        continue
+
+      # Termination Condition 2: pano_id_to_process has already been processed.
+      # The current path leading up to it is a complete line segment.
+      if pano_id_to_process in processed_pano_ids:
+        add_feature(accumulated_path_nodes, colored=False)
+        continue
+
+      processed_pano_ids.add(pano_id_to_process)
+      claimed = True
+      if claim is not None and not claim(pano_id_to_process):
+        add_feature(accumulated_path_nodes, colored=False)
+        continue
+      data = prefetcher.get(pano_id_to_process)
+      if data is None:  # No such pano
+        add_feature(accumulated_path_nodes)  # Save path so far
+        continue
+
+      lat = data.get("lat")
+      lng = data.get("lng")
+      links_api = data.get("links", [])
+      if lat is None or lng is None:
+        print(f"Warning: No lat/lng for pano {pano_id_to_process}. Data: {data}")
+        add_feature(accumulated_path_nodes)  # Save path so far
+        continue
+      if accept is not None and not accept(pano_id_to_process, data):
+        add_feature(([lng, lat], pano_id_to_process, accumulated_path_nodes))
+        continue
+      graph_nodes[pano_id_to_process] = (
+          lat, lng, data.get("originalLat"), data.get("originalLng"),
+          [(link["panoId"], link.get("heading", 0.0)) for link in links_api if link.get("panoId")],
+      )
+      print(data['date'])
+      link_ids = [link.get("panoId") for link in links_api]
+      # Current pano is valid, print its info
+      print(f"PanoID: {pano_id_to_process}, Lat: {lat}, Lng: {lng}, \n  Links: {link_ids}")
+
+      # Path extended with the current pano's data
+      new_accumulated_path = ([lng, lat], pano_id_to_process, accumulated_path_nodes)
+
+      explorable_linked_pano_ids = []
+      if isinstance(links_api, list):
+        for link in links_api:
+          linked_pano_id = link.get("panoId")
+          # Explore link if it has a panoId AND it hasn't been processed globally yet
+          if linked_pano_id and linked_pano_id not in processed_pano_ids:
+            if follow is not None and not follow(data, link):
+              if hand_off is not None:
+                hand_off(pano_id_to_process, data, link)
+              continue
+            explorable_linked_pano_ids.append(linked_pano_id)
+
+      if not explorable_linked_pano_ids:
+        # This node is a terminal node for new exploration.
+        # The new_accumulated_path (including current node) is a complete line.
+        add_feature(new_accumulated_path)
+        continue
+
+      # Branch out: pushed in reverse so the first link is walked (to the end) first
+      for next_pano_id in explorable_linked_pano_ids:
+        prefetcher.prefetch(next_pano_id)
+      for next_pano_id in reversed(explorable_linked_pano_ids):
+        stack.append((next_pano_id, current_depth + 1, new_accumulated_path))
+    entry = None
+  except BaseException:
+    if checkpoint_file:
+      if entry is not None:
+        # Put back the pano that was being processed, so it is retried on resume.
+        if claimed:
+          processed_pano_ids.discard(entry[0])
+          graph_nodes.pop(entry[0], None)
+        stack.append(entry)
+      save_checkpoint(checkpoint_file, initial_pano_id, stack)
+      print(f"Crawl stopped; state saved to {checkpoint_file}, continue it with --resume")
+    raise
+  finally:
+    prefetcher.shutdown()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Crawl linked panos into GeoJSON LineStrings.")
+  parser.add_argument("pano", nargs="?", help="PanoID to start from (not needed with --resume).")
+  parser.add_argument("--max-depth", type=int, default=MAX_DEPTH)
+  parser.add_argument("--max-nodes", type=int, help="Stop expanding after this many panos.")
+  parser.add_argument("--workers", type=int, default=FETCH_WORKERS, help="Metadata requests in flight.")
+  parser.add_argument("--checkpoint", default=CHECKPOINT_FILE,
+                      help="File the crawl state is saved to periodically; empty to disable.")
+  parser.add_argument("--resume", action="store_true", help="Carry on the crawl saved in --checkpoint.")
+  parser.add_argument("--output", default="output.geojson",
+                      help="GeoJSON file features are streamed to; .ndjson for one feature per line.")
+  parser.add_argument("--indent", type=int, help="Pretty print FeatureCollection output.")
+  parser.add_argument("--compact", metavar="PREFIX",
+                      help="Also write simplified, encoded lines and a pano ID side table (see polyline.py).")
+  parser.add_argument("--tolerance", type=float, default=polyline.TOLERANCE,
+                      help="Simplification tolerance in meters for --compact.")
+  args = parser.parse_args()
+
+  if args.resume:
+    initial_pano_id, stack = load_checkpoint(args.checkpoint)
+    print(f"Resuming scrape from PanoID: {initial_pano_id} with {len(processed_pano_ids)} panos done"
+          f" and {len(stack)} pending")
+  elif args.pano:
+    # Initial panorama ID from your example
+    initial_pano_id = args.pano
+    stack = None
+    reset(geojsonstream.FeatureWriter(args.output, indent=args.indent))  # Ensure state is empty for a fresh run
+    print(
+        f"Starting scrape from PanoID: {initial_pano_id} up to {args.max_depth} levels"
+        " deep to build LineStrings."
+    )
+  else:
+    parser.error("a PanoID is required unless --resume is given")
+
+  try:
+    crawl(initial_pano_id, args.max_depth, args.max_nodes, args.workers, args.checkpoint or None, stack)
+  except requests.exceptions.RequestException as e:
+    print(f"Crawl stopped by an API error: {e}")
+    sys.exit(1)
+  feature_writer.close()
+  print(f"GeoJSON LineString data ({feature_writer.count} features) written to {feature_writer.path}")
+  if args.compact:
+    count, before, after = polyline.compact(feature_writer.path, args.compact, args.tolerance)
+    print(f"Compact lines ({after} of {before} vertices kept) written to {args.compact}.lines.json")
 
-# Write the GeoJSON data to output.geojson
-output_filename = "output.geojson"
-with open(output_filename, "w") as f:
-  json.dump(geojson_output, f, indent=2)  # indent for pretty printing
+  graph_dirname = "output.graph"
+  graph = panograph.from_nodes(graph_nodes)
+  graph.save(graph_dirname)
+  print(f"Pano graph ({len(graph)} panos, {graph.edge_count} links) written to {graph_dirname}")
 
-print(f"GeoJSON LineString data written to {output_filename}")
-# The user's original comment with the example JSON response is omitted for brevity.
+  if args.checkpoint and os.path.exists(args.checkpoint):
+    os.remove(args.checkpoint)
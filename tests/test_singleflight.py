@@ -0,0 +1,84 @@
+import threading
+import time
+import pytest
+import singleflight
+
+FOLLOWERS = 8
+
+
+def run_concurrently(group, fn):
+    """Calls group.do("key", fn) from FOLLOWERS + 1 threads and returns what each got."""
+    outcomes = [None] * (FOLLOWERS + 1)
+
+    def call(i):
+        try:
+            outcomes[i] = ("result", group.do("key", fn))
+        except Exception as e:
+            outcomes[i] = ("error", e)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(FOLLOWERS + 1)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def wait_for_followers(group, timeout=5):
+    """Waits until every follower is blocked on the leader's result."""
+    condition = group._calls["key"]._condition
+    deadline = time.monotonic() + timeout
+    while len(condition._waiters) < FOLLOWERS:
+        assert time.monotonic() < deadline, "followers never waited on the leader"
+        time.sleep(0.001)
+
+
+def test_followers_share_the_leaders_result():
+    group = singleflight.Group()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return {"panoIds": ["a"]}
+
+    threads, outcomes = run_concurrently(group, fn)
+    started.wait()
+    wait_for_followers(group)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert all(outcome == ("result", {"panoIds": ["a"]}) for outcome in outcomes)
+    assert outcomes[0][1] is outcomes[-1][1]
+
+
+def test_followers_get_the_leaders_exception():
+    group = singleflight.Group()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait()
+        raise KeyError("panoIds")
+
+    threads, outcomes = run_concurrently(group, fn)
+    started.wait()
+    wait_for_followers(group)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert all(kind == "error" and isinstance(e, KeyError) for kind, e in outcomes)
+
+
+def test_key_is_forgotten_once_the_call_finishes():
+    group = singleflight.Group()
+    results = iter([1, 2])
+    assert group.do("key", next, results) == 1
+    assert group.do("key", next, results) == 2
+    with pytest.raises(ValueError):
+        group.do("key", int, "not a number")
+    assert group._calls == {}
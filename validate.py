@@ -13,35 +13,292 @@ def process_item(item):
     or None if there is no difference between the sets.
   """
   options = internet_roadtrip_panos.predict_options(item['pano'], float(item['heading']))
+  return compare_options(item, options)
+
+def compare_options(item, options):
+  """Compares predicted options against the options recorded for a stop.
+
+  Args:
+    item: A dictionary containing 'pano', 'heading', 'options', and 'stop'.
+    options: The predicted options for the item.
+
+  Returns:
+    Same as process_item.
+  """
   estimated = set([x['pano'] for x in options])
   action = set([x['pano'] for x in item['options']])
   if len(estimated - action) or len(action - estimated):
     return (item['stop'], estimated - action, action - estimated)
   return None
 
+# Result for a stop that could not be validated, because its lookups failed.
+FAILED = "failed"
+
+def process_batch(items):
+  """Processes several items with a single batched prediction.
+
+  The panoIds lookups for every item are packed into shared requests, and
+  panos that show up for more than one item are only fetched once. If the
+  batched prediction fails as a whole, each item is processed on its own
+  instead, so one bad response only costs the stops it belongs to.
+
+  Args:
+    items: A list of dictionaries, as passed to process_item.
+
+  Returns:
+    A list with the process_item result for each item, or FAILED for an
+    item that could not be validated.
+  """
+  stops = [(item['pano'], float(item['heading'])) for item in items]
+  try:
+    predicted = internet_roadtrip_panos.predict_options_many(stops)
+  except Exception as e:
+    print("Batch of %d stops failed, validating them one at a time: %r" % (len(items), e))
+    return [try_process_item(item) for item in items]
+  results = []
+  for item, options in zip(items, predicted):
+    if options is None:
+      print("Could not validate stop %s" % item['stop'])
+      results.append(FAILED)
+    else:
+      results.append(compare_options(item, options))
+  return results
+
+def try_process_item(item):
+  """Same as process_item, but reports an error and returns FAILED."""
+  try:
+    return process_item(item)
+  except Exception as e:
+    print("Could not validate stop %s: %r" % (item['stop'], e))
+    return FAILED
+
+import argparse
 import csv
+import itertools
+import os
+import shutil
+import ratelimit
+
+# Number of stops sent through one predict_options_many call.
+BATCH_SIZE = 100
+MAX_IN_FLIGHT = 4  # Batches submitted but not yet written out, per worker
+OUTPUT_FILE = "failures.csv"
+READ_SIZE = 1 << 16  # Bytes read at a time when parsing a JSON array
+
+
+def iter_json_array(f):
+    """Yields the elements of a top-level JSON array without loading it all."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    while True:
+        chunk = f.read(READ_SIZE)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if not started and position < len(buffer):
+                if buffer[position] != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                position += 1
+                continue
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if not chunk:
+                    raise
+                break  # Element continues in the next chunk.
+            yield item
+            position = end
+        if not chunk:
+            return
+
+
+def iter_items(path):
+    """Yields stops from a JSON lines file (.jsonl) or a JSON array file, one at a time."""
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(f)
+
+
+def checkpoint_path(output):
+    return output + ".done"
+
+
+def load_checkpoint(output):
+    """Returns the stops already written out by an earlier run into output."""
+    try:
+        with open(checkpoint_path(output)) as f:
+            return set(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
+        return set()
+
+
+def process_stream(items, max_workers=1, batch_size=BATCH_SIZE, output=OUTPUT_FILE, resume=False):
+    """Validates a stream of stops, writing failures out as batches complete.
+
+    At most max_workers * MAX_IN_FLIGHT batches are held in memory at once.
+    Each finished batch's failures are appended to the output CSV, and then
+    its stops to a checkpoint file beside it, so a run that dies can be
+    picked up again with resume=True. A batch that was written to the CSV
+    but not checkpointed is validated again and may show up twice. Stops
+    that could not be validated are left out of the checkpoint, so a resumed
+    run tries them again.
+
+    Args:
+      items: An iterable of dictionaries, each containing data for a single item.
+      max_workers: The maximum number of worker threads to use.
+      batch_size: The number of items predicted together in one batch.
+      output: The CSV file failures are written to.
+      resume: Skip stops in the checkpoint and append to output, instead of starting over.
+
+    Returns:
+      The number of stops validated in this run.
+    """
+    done = load_checkpoint(output) if resume else set()
+    mode = "a" if resume else "w"
+    remaining = (item for item in items if str(item['stop']) not in done)
+    batches = iter(lambda: list(itertools.islice(remaining, batch_size)), [])
+    processed = 0
+    with open(output, mode, newline="") as out, open(checkpoint_path(output), mode) as checkpoint, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        w = csv.writer(out)
+        in_flight = {}
+
+        def submit_more():
+            for batch in itertools.islice(batches, max_workers * MAX_IN_FLIGHT - len(in_flight)):
+                in_flight[executor.submit(process_batch, batch)] = batch
+
+        submit_more()
+        while in_flight:
+            finished, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                batch = in_flight.pop(future)
+                results = future.result()
+                for result in results:
+                  if result and result is not FAILED:
+                    stop, estimated_minus_action, action_minus_estimated = result
+                    w.writerow([stop, len(estimated_minus_action), len(action_minus_estimated)])
+                    print("Set delta: %s, %s, %s" % (stop, estimated_minus_action, action_minus_estimated))
+                out.flush()
+                validated = [item for item, result in zip(batch, results) if result is not FAILED]
+                checkpoint.writelines("%s\n" % item['stop'] for item in validated)
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                processed += len(validated)
+            submit_more()
+    return processed
 
 
-def process_data_in_parallel(data, max_workers=1):
+def process_data_in_parallel(data, max_workers=1, batch_size=BATCH_SIZE):
     """Processes data in parallel using a thread pool.
 
     Args:
       data: A list of dictionaries, each containing data for a single item.
       max_workers: The maximum number of worker threads to use.
+      batch_size: The number of items predicted together in one batch.
+    """
+    process_stream(data, max_workers, batch_size)
+
+
+def shard_output(output, shard):
+    return "%s.shard%d" % (output, shard)
+
+
+def shard_input(output, shard):
+    return "%s.shard%d.jsonl" % (output, shard)
+
+
+def split_input(path, shards, output):
+    """Deals the stops of an input file out round robin into one JSON lines file per shard.
+
+    JSON lines input is split line by line without being decoded; a JSON
+    array is decoded once, here, and its stops written back out one per line.
+
+    Returns:
+      The shard input paths.
+    """
+    paths = [shard_input(output, shard) for shard in range(shards)]
+    files = [open(shard_path, "w") for shard_path in paths]
+    try:
+        if path.endswith(".jsonl"):
+            with open(path) as f:
+                lines = (line if line.endswith("\n") else line + "\n" for line in f if line.strip())
+                for index, line in enumerate(lines):
+                    files[index % shards].write(line)
+        else:
+            for index, item in enumerate(iter_items(path)):
+                files[index % shards].write(json.dumps(item) + "\n")
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def run_shard(shard_path, max_workers, batch_size, output, resume):
+    """Validates the stops in one shard's input file.
+
+    Runs in a worker process, which reads and decodes only its own shard,
+    and writes its own CSV and checkpoint.
+
+    Returns:
+      The number of stops validated.
     """
-    w = csv.writer(open("failures.csv", "w"))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(process_item, item) for item in data]
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            if result:
-              stop, estimated_minus_action, action_minus_estimated = result
-              w.writerow([stop, len(estimated_minus_action), len(action_minus_estimated)])
-              print("Set delta: %s, %s, %s" % (stop, estimated_minus_action, action_minus_estimated))
-
-
-# Example of how to call the function:
-# Assuming your data is in a variable called 'data'
-data = json.load(open("failed.json"))
-#data = [i for i in data if i['stop'] == "231160"]
-process_data_in_parallel(data)
+    return process_stream(iter_items(shard_path), max_workers, batch_size, output, resume)
+
+
+def process_sharded(path, shards, max_workers=1, batch_size=BATCH_SIZE, output=OUTPUT_FILE, resume=False):
+    """Validates an input file across several worker processes.
+
+    The input is split once, round robin, into per-shard JSON lines files
+    beside output. Each process runs process_stream over its own file with
+    its own thread pool and a 1/shards share of the API rate limits; their
+    CSVs are merged into output once every shard is done. The per-shard
+    files are kept, since they hold the checkpoints --resume needs.
+
+    Returns:
+      The number of stops validated in this run.
+    """
+    paths = split_input(path, shards, output)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=shards, initializer=ratelimit.share,
+                                                initargs=(shards,)) as executor:
+        futures = [executor.submit(run_shard, shard_path, max_workers, batch_size, shard_output(output, shard), resume)
+                   for shard, shard_path in enumerate(paths)]
+        counts = [future.result() for future in futures]
+    failures = 0
+    with open(output, "w", newline="") as out:
+        for shard in range(shards):
+            with open(shard_output(output, shard), newline="") as f:
+                failures += sum(1 for line in f if line.strip())
+                f.seek(0)
+                shutil.copyfileobj(f, out)
+    print("Shards validated %s stops; %d failures in total written to %s" % (counts, failures, output))
+    return sum(counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check predicted options against recorded stops.")
+    parser.add_argument("input", nargs="?", default="failed.json",
+                        help="Recorded stops as a JSON array or a .jsonl file.")
+    parser.add_argument("--output", default=OUTPUT_FILE, help="CSV file failures are written to.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker threads.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Worker processes to split the stops across, each with --workers threads.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip stops an earlier run already checkpointed and append to the output.")
+    args = parser.parse_args()
+    if args.shards > 1:
+        count = process_sharded(args.input, args.shards, args.workers, args.batch_size, args.output, args.resume)
+    else:
+        count = process_stream(iter_items(args.input), args.workers, args.batch_size, args.output, args.resume)
+    print(f"Validated {count} stops")